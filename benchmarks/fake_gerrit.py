@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Copyright 2014 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stand-in for 'ssh <host> gerrit ...' used by the benchmarks.
+
+Installed as 'ssh' in a directory put first on PATH, this script
+answers the Gerrit ssh commands git-change runs, after sleeping for a
+configurable latency to simulate the network round trip:
+
+    gerrit query --format=JSON ...    Prints the changes whose IDs
+                                      appear in the query, from the
+                                      fixtures file; changes missing
+                                      from it are reported as open
+                                      changes on master.
+    gerrit review ...                 Accepted and ignored.
+    gerrit set-reviewers ...          Accepted and ignored.
+
+It is configured through environment variables:
+
+    GIT_CHANGE_BENCH_FIXTURES   JSON file mapping change IDs to Gerrit
+                                change objects.
+    GIT_CHANGE_BENCH_LATENCY    Latency of every command in seconds.
+    GIT_CHANGE_BENCH_LOG        File to which each command line is
+                                appended.
+"""
+
+import os
+import re
+import sys
+import time
+
+import simplejson
+
+CHANGE_ID_PATTERN = re.compile(r'\bchange:(I[0-9a-f]{40})\b')
+
+
+def load_fixtures():
+    """Returns the change fixtures, a dictionary keyed by change ID."""
+    path = os.environ.get('GIT_CHANGE_BENCH_FIXTURES')
+    if not path:
+        return {}
+    with open(path) as f:
+        return simplejson.load(f)
+
+
+def default_change(change_id, number):
+    """Returns a Gerrit change object for a change without a fixture."""
+    return {
+        'project': 'bench',
+        'branch': 'master',
+        'id': change_id,
+        'number': str(number),
+        'subject': 'Change %s' % change_id[:8],
+        'url': 'https://gerrit.example.com/%d' % number,
+        'lastUpdated': 1400000000,
+        'open': True,
+        'status': 'NEW',
+        }
+
+
+def query(args):
+    """Prints the response to a 'gerrit query --format=JSON'."""
+    fixtures = load_fixtures()
+    change_ids = CHANGE_ID_PATTERN.findall(' '.join(args))
+    for number, change_id in enumerate(change_ids, 1):
+        change = fixtures.get(change_id) or default_change(change_id, number)
+        print simplejson.dumps(change)
+    print simplejson.dumps({'type': 'stats', 'rowCount': len(change_ids), 'runTimeMilliseconds': 1})
+
+
+def main(argv):
+    log = os.environ.get('GIT_CHANGE_BENCH_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.write('%s\n' % ' '.join(argv[1:]))
+    time.sleep(float(os.environ.get('GIT_CHANGE_BENCH_LATENCY', '0')))
+
+    if 'gerrit' not in argv:
+        sys.stderr.write('fake ssh: only gerrit commands are supported\n')
+        return 255
+    args = argv[argv.index('gerrit') + 1:]
+    if not args:
+        sys.stderr.write('fake gerrit: missing command\n')
+        return 1
+    if args[0] == 'query':
+        query(args[1:])
+    elif args[0] not in ('review', 'set-reviewers'):
+        sys.stderr.write('fake gerrit: %s: not supported\n' % args[0])
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+# Copyright 2014 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks of git-change subcommands.
+
+Generates a synthetic repository (see synthetic_repo.py) with a local
+bare remote, puts a fake ssh that answers Gerrit commands (see
+fake_gerrit.py) first on PATH, then times git-change subcommands in
+it and writes the results as JSON, e.g.:
+
+    python benchmarks/run.py --files=50000 --latency=0.1 --output=results.json
+
+Each operation is run --repeat times; any untimed setup it needs
+(staging a change, checking out a branch) is done before each run.
+Results from different revisions of git-change can be compared to
+track performance regressions. With --trace-dir, a Chrome trace of the
+subprocesses of every run is written too (see git_change/tracing.py).
+"""
+
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import gflags
+import simplejson
+
+import synthetic_repo
+
+gflags.DEFINE_integer('repeat', 3, 'Number of timed runs of each operation.')
+gflags.DEFINE_float('latency', 0.05, 'Latency of each fake Gerrit ssh command, in seconds.')
+gflags.DEFINE_list('operations', None,
+                   'Comma-separated list of operations to run. Defaults to all of them.')
+gflags.DEFINE_string('output', None, 'File to write the JSON results to. Defaults to stdout.')
+gflags.DEFINE_string('trace-dir', None,
+                     'Directory to write a Chrome trace of each run to.')
+gflags.DEFINE_string('work-dir', None,
+                     'Directory to generate the repository in. Defaults to a temporary '
+                     'directory, which is removed afterwards.')
+
+FLAGS = gflags.FLAGS
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# Runs git-change from this source tree rather than an installed copy.
+GIT_CHANGE = [sys.executable, '-c',
+              'import sys; sys.argv[0] = "git-change"; '
+              'from git_change.git_change import app; app()']
+
+FAKE_SSH = """#!/bin/sh
+exec "%s" "%s" "$@"
+"""
+
+
+class Benchmark(object):
+    """Runs git-change operations in a generated repository."""
+
+    def __init__(self, root, setup):
+        self.root = root
+        self.work = setup['work']
+        self.paths = setup['paths']
+        self.chain = setup['chain']
+        self.change_ids = setup['change_ids']
+        self.created_branch = None
+        self.counter = 0
+        self.env = self._make_env()
+        self.trace_file = None
+
+    def _make_env(self):
+        """Sets up the fake ssh and returns the environment for git-change."""
+        bin_dir = os.path.join(self.root, 'bin')
+        os.mkdir(bin_dir)
+        ssh = os.path.join(bin_dir, 'ssh')
+        with open(ssh, 'w') as f:
+            f.write(FAKE_SSH % (sys.executable, os.path.join(BENCHMARKS_DIR, 'fake_gerrit.py')))
+        os.chmod(ssh, 0755)
+
+        fixtures = dict((change_id, {
+            'project': 'bench',
+            'branch': 'master',
+            'id': change_id,
+            'number': str(number),
+            'subject': 'Change %d' % number,
+            'url': 'https://gerrit.example.com/%d' % number,
+            'lastUpdated': 1400000000,
+            'open': True,
+            'status': 'NEW',
+            }) for number, change_id in enumerate(self.change_ids, 1))
+        fixtures_file = os.path.join(self.root, 'fixtures.json')
+        with open(fixtures_file, 'w') as f:
+            simplejson.dump(fixtures, f)
+
+        env = os.environ.copy()
+        env.update({
+            'PATH': '%s%s%s' % (bin_dir, os.pathsep, env.get('PATH', '')),
+            'PYTHONPATH': SOURCE_DIR,
+            'GIT_CHANGE_BENCH_FIXTURES': fixtures_file,
+            'GIT_CHANGE_BENCH_LATENCY': str(FLAGS.latency),
+            # 'git commit --amend' (e.g. in update) must not wait for
+            # an editor.
+            'GIT_EDITOR': 'true',
+            'EDITOR': 'true',
+            'VISUAL': 'true',
+            })
+        return env
+
+    def git(self, *args):
+        """Runs an untimed git command in the work clone."""
+        subprocess.check_call(('git',) + args, cwd=self.work, env=self.env,
+                              stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+    def stage_change(self):
+        """Modifies a file and stages the modification."""
+        self.counter += 1
+        path = self.paths[self.counter * 7919 % len(self.paths)]
+        with open(os.path.join(self.work, path), 'a') as f:
+            f.write('benchmark change %d\n' % self.counter)
+        self.git('add', path)
+
+    def git_change(self, *args):
+        """Runs git-change and returns (wall time, return code, output)."""
+        env = self.env
+        if self.trace_file is not None:
+            env = dict(env, GIT_CHANGE_TRACE=self.trace_file)
+        start = time.time()
+        process = subprocess.Popen(GIT_CHANGE + list(args), cwd=self.work, env=env,
+                                   stdin=open(os.devnull), stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output, _ = process.communicate()
+        return time.time() - start, process.returncode, output
+
+    # Each operation does its untimed setup and returns the result of
+    # the timed git_change() call.
+
+    def op_print(self):
+        self.git('checkout', '--quiet', self.chain[-1])
+        return self.git_change('print')
+
+    def op_list(self):
+        self.git('checkout', '--quiet', 'master')
+        return self.git_change('list')
+
+    def op_owners(self):
+        """Times OWNERS resolution for the commits of the chain."""
+        code = ('import sys, gflags; from git_change import git_owners; '
+                'gflags.FLAGS(["bench"]); '
+                'sys.stdout.write(" ".join(sorted(git_owners.get_change_owners(sys.argv[1]))))')
+        commits = 'origin/master..%s' % self.chain[-1]
+        start = time.time()
+        process = subprocess.Popen([sys.executable, '-c', code, commits],
+                                   cwd=self.work, env=self.env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output, _ = process.communicate()
+        return time.time() - start, process.returncode, output
+
+    def op_create(self):
+        self.git('checkout', '--quiet', 'master')
+        self.stage_change()
+        result = self.git_change('create', '--message=Benchmark change %d' % self.counter)
+        self.created_branch = self._newest_change_branch()
+        return result
+
+    def op_create_in_place(self):
+        self.git('checkout', '--quiet', 'master')
+        self.stage_change()
+        return self.git_change('create', '--in-place',
+                               '--message=Benchmark change %d' % self.counter)
+
+    def op_update(self):
+        if self.created_branch is None:
+            self.op_create()
+        self.git('checkout', '--quiet', self.created_branch)
+        self.stage_change()
+        return self.git_change('update')
+
+    def op_gc(self):
+        self.git('checkout', '--quiet', 'master')
+        return self.git_change('gc')
+
+    def op_gc_gerrit(self):
+        self.git('checkout', '--quiet', 'master')
+        return self.git_change('gc', '--gerrit')
+
+    def op_push_stack(self):
+        self.git('checkout', '--quiet', self.chain[-1])
+        return self.git_change('push-stack')
+
+    def op_rebase_stack(self):
+        self.git('checkout', '--quiet', self.chain[-1])
+        return self.git_change('rebase', '--stack')
+
+    def op_rebase(self):
+        self.git('checkout', '--quiet', 'change-%s' % self.change_ids[0])
+        return self.git_change('rebase')
+
+    def _newest_change_branch(self):
+        output = subprocess.check_output(
+            ['git', 'for-each-ref', '--sort=-creatordate', '--count=1',
+             '--format=%(refname:short)', 'refs/heads/change-*'], cwd=self.work)
+        return output.strip() or None
+
+
+OPERATIONS = ['print', 'list', 'owners', 'create', 'create-in-place', 'update', 'gc',
+              'gc-gerrit', 'push-stack', 'rebase-stack', 'rebase']
+
+
+def summarize(times):
+    """Returns min, median and mean of a list of times."""
+    if not times:
+        return {}
+    ordered = sorted(times)
+    return {
+        'min': ordered[0],
+        'median': ordered[len(ordered) // 2],
+        'mean': sum(ordered) / len(ordered),
+        }
+
+
+def run_benchmarks(root):
+    """Generates the repository under root and runs all operations.
+
+    Returns:
+        A dictionary of results, ready to be serialized as JSON.
+    """
+    parameters = {
+        'files': FLAGS.files,
+        'depth': FLAGS.depth,
+        'owners_density': FLAGS['owners-density'].value,
+        'branches': FLAGS.branches,
+        'chain_length': FLAGS['chain-length'].value,
+        'seed': FLAGS.seed,
+        'latency': FLAGS.latency,
+        'repeat': FLAGS.repeat,
+        }
+    start = time.time()
+    setup = synthetic_repo.generate(root, FLAGS.files, FLAGS.depth,
+                                    FLAGS['owners-density'].value, FLAGS.branches,
+                                    FLAGS['chain-length'].value, FLAGS.seed)
+    generate_time = time.time() - start
+    benchmark = Benchmark(root, setup)
+
+    results = {}
+    for operation in FLAGS.operations or OPERATIONS:
+        if operation not in OPERATIONS:
+            raise gflags.FlagsError('Unknown operation: %s' % operation)
+        method = getattr(benchmark, 'op_%s' % operation.replace('-', '_'))
+        runs = []
+        failures = []
+        for i in xrange(FLAGS.repeat):
+            if FLAGS['trace-dir'].value:
+                benchmark.trace_file = os.path.join(FLAGS['trace-dir'].value,
+                                                    '%s-%d.json' % (operation, i))
+            elapsed, return_code, output = method()
+            if return_code:
+                failures.append({'run': i, 'return_code': return_code,
+                                 'output': output[-2000:]})
+            else:
+                runs.append(elapsed)
+            sys.stderr.write('%-16s run %d: %.3fs%s\n' % (
+                operation, i, elapsed, ' (failed)' if return_code else ''))
+        result = summarize(runs)
+        result['runs'] = runs
+        if failures:
+            result['failures'] = failures
+        results[operation] = result
+
+    git_version = subprocess.check_output(['git', 'version']).strip()
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git_version': git_version,
+        'python_version': platform.python_version(),
+        'parameters': parameters,
+        'generate_time': generate_time,
+        'operations': results,
+        }
+
+
+def main(argv):
+    if len(argv) != 1:
+        sys.stderr.write('Usage: %s [flags]\n' % argv[0])
+        sys.exit(1)
+    if FLAGS['trace-dir'].value:
+        FLAGS['trace-dir'].value = os.path.abspath(FLAGS['trace-dir'].value)
+        if not os.path.isdir(FLAGS['trace-dir'].value):
+            os.makedirs(FLAGS['trace-dir'].value)
+
+    if FLAGS['work-dir'].value:
+        root = os.path.abspath(FLAGS['work-dir'].value)
+        if not os.path.isdir(root):
+            os.makedirs(root)
+    else:
+        root = tempfile.mkdtemp(prefix='git-change-bench.')
+    try:
+        results = run_benchmarks(root)
+    finally:
+        if not FLAGS['work-dir'].value:
+            shutil.rmtree(root)
+
+    output = simplejson.dumps(results, indent=2, sort_keys=True)
+    if FLAGS.output:
+        with open(FLAGS.output, 'w') as f:
+            f.write('%s\n' % output)
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    try:
+        argv = FLAGS(sys.argv)
+    except gflags.FlagsError, e:
+        sys.stderr.write('%s\n%s' % (e, FLAGS))
+        sys.exit(1)
+    main(argv)
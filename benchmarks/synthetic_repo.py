@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+# Copyright 2014 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generator of synthetic repositories for benchmarking git-change.
+
+A generated setup consists of a bare repository standing in for the
+Gerrit remote and a clone of it to run git-change in:
+
+    <root>/remote.git   Bare remote. A post-receive hook moves every
+                        push to refs/for/<branch> out of the way, to
+                        refs/changes/<n>, so that like with Gerrit,
+                        each push creates a new patch set.
+    <root>/work         Clone with master tracking origin/master,
+                        OWNERS support and push options enabled, and
+                        a number of change branches (with git-change
+                        notes) plus a chain of chained change
+                        branches.
+
+All objects are written with a single 'git fast-import' per
+repository, so even large repositories are generated quickly.
+
+Run as a script to generate a repository without running benchmarks.
+"""
+
+import hashlib
+import os
+import random
+import subprocess
+import sys
+
+import gflags
+import simplejson
+
+gflags.DEFINE_integer('files', 1000, 'Number of files in the repository.')
+gflags.DEFINE_integer('depth', 3, 'Directory depth of the files.')
+gflags.DEFINE_float('owners-density', 0.2,
+                    'Fraction of directories that have an OWNERS file.')
+gflags.DEFINE_integer('branches', 20, 'Number of unrelated change branches.')
+gflags.DEFINE_integer('chain-length', 5, 'Number of change branches in the chain.')
+gflags.DEFINE_integer('seed', 0, 'Seed of the random number generator.')
+
+FLAGS = gflags.FLAGS
+
+NOTES_REF = 'refs/notes/git-change'
+
+IDENT = 'Bench Mark <bench@example.com> 1400000000 +0000'
+
+USERS = ['user%d' % i for i in xrange(20)]
+
+POST_RECEIVE_HOOK = """#!/bin/sh
+# Stand-in for Gerrit: refs/for/<branch> never persists, so every push
+# to it creates a new "patch set".
+while read old new ref; do
+    case "$ref" in
+    refs/for/*)
+        n=$(git for-each-ref refs/changes | wc -l)
+        git update-ref "refs/changes/$n" "$new"
+        git update-ref -d "$ref"
+        ;;
+    esac
+done
+"""
+
+
+def run(args, cwd, stdin_data=None):
+    """Runs a command and returns its stdout, raising on failure."""
+    process = subprocess.Popen(args, cwd=cwd, stdin=subprocess.PIPE if stdin_data else None,
+                               stdout=subprocess.PIPE)
+    stdout, _ = process.communicate(stdin_data)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, ' '.join(args))
+    return stdout
+
+
+def _data(content):
+    """Returns a fast-import data command for the given content."""
+    return 'data %d\n%s\n' % (len(content), content)
+
+
+def get_file_paths(files, depth):
+    """Returns the paths of the files of a synthetic repository.
+
+    Files are spread evenly over a directory tree of the given depth.
+
+    Args:
+        files: An integer representing the number of files.
+        depth: An integer representing the directory depth.
+
+    Returns:
+        A list of strings representing relative file paths.
+    """
+    fanout = max(2, int(round(files ** (1.0 / (depth + 1)))))
+    paths = []
+    for i in xrange(files):
+        dirs = ['d%d' % ((i // fanout ** (level + 1)) % fanout) for level in xrange(depth)]
+        paths.append('/'.join(dirs + ['file%d.txt' % i]))
+    return paths
+
+
+def get_change_id(name):
+    """Returns a deterministic change ID for the given name."""
+    return 'I%s' % hashlib.sha1(name).hexdigest()
+
+
+def _build_base_stream(paths, owners_density, rng):
+    """Returns a fast-import stream for the initial master commit."""
+    directories = sorted(set(os.path.dirname(path) for path in paths))
+    stream = ['commit refs/heads/master\n',
+              'committer %s\n' % IDENT,
+              _data('Initial commit')]
+    stream.append('M 644 inline OWNERS\n%s' % _data('\n'.join(rng.sample(USERS, 2))))
+    for directory in directories:
+        if directory and rng.random() < owners_density:
+            stream.append('M 644 inline %s/OWNERS\n%s' % (
+                directory, _data('\n'.join(rng.sample(USERS, 2)))))
+    for path in paths:
+        stream.append('M 644 inline %s\n%s' % (path, _data('%s\n' % path)))
+    return ''.join(stream)
+
+
+def _build_change_stream(base, paths, branches, chain_length, rng):
+    """Returns a fast-import stream of change branches and their notes.
+
+    Returns:
+        A tuple (stream, chain) where chain is a list of the names of
+        the chained change branches, from the bottom up.
+    """
+    stream = []
+    notes = []
+    mark = 1
+
+    def add_commit(branch, parent, name, path, note):
+        change_id = get_change_id(name)
+        stream.append('commit refs/heads/%s\nmark :%d\ncommitter %s\n%sfrom %s\n' % (
+            branch % change_id, mark, IDENT,
+            _data('%s\n\nChange-Id: %s\n' % (name, change_id)), parent))
+        stream.append('M 644 inline %s\n%s' % (path, _data('%s changed by %s\n' % (path, name))))
+        note['Change-Id'] = change_id
+        note['Note-Version'] = 1
+        notes.append((mark, note))
+        return change_id
+
+    for i in xrange(branches):
+        add_commit('change-%s', base, 'Change %d' % i, rng.choice(paths),
+                   {'Target-Branch': 'master', 'Parent-Branch': 'master'})
+        mark += 1
+
+    chain = []
+    parent, parent_branch = base, 'master'
+    for i in xrange(chain_length):
+        change_id = add_commit('change-%s', parent, 'Chained change %d' % i, rng.choice(paths),
+                               {'Target-Branch': 'master', 'Parent-Branch': parent_branch})
+        parent, parent_branch = ':%d' % mark, 'change-%s' % change_id
+        chain.append(parent_branch)
+        mark += 1
+
+    if notes:
+        stream.append('commit %s\ncommitter %s\n%s' % (NOTES_REF, IDENT,
+                                                        _data('Notes added by git-change')))
+        for note_mark, note in notes:
+            stream.append('N inline :%d\n%s' % (note_mark, _data(
+                simplejson.dumps(note, sort_keys=True, separators=(',', ':')))))
+    return ''.join(stream), chain
+
+
+def generate(root, files=1000, depth=3, owners_density=0.2, branches=20, chain_length=5,
+             seed=0):
+    """Generates a bare remote and a work clone under root.
+
+    Args:
+        root: A string representing an empty or nonexistent directory.
+        files: An integer representing the number of files.
+        depth: An integer representing the directory depth of files.
+        owners_density: A float representing the fraction of
+            directories with an OWNERS file.
+        branches: An integer representing the number of unrelated
+            change branches to create in the work clone.
+        chain_length: An integer representing the number of chained
+            change branches to create in the work clone.
+        seed: An integer used to seed the random number generator.
+
+    Returns:
+        A dictionary describing the generated setup, with keys 'remote',
+        'work', 'paths' and 'chain' (the chained change branches from
+        the bottom up) and 'change_ids' (the change IDs of all change
+        branches).
+    """
+    rng = random.Random(seed)
+    remote = os.path.join(root, 'remote.git')
+    work = os.path.join(root, 'work')
+    paths = get_file_paths(files, depth)
+
+    run(['git', 'init', '--quiet', '--bare', remote], cwd=root)
+    run(['git', 'fast-import', '--quiet'], cwd=remote,
+        stdin_data=_build_base_stream(paths, owners_density, rng))
+    hook = os.path.join(remote, 'hooks', 'post-receive')
+    with open(hook, 'w') as f:
+        f.write(POST_RECEIVE_HOOK)
+    os.chmod(hook, 0755)
+    run(['git', 'config', 'receive.advertisePushOptions', 'true'], cwd=remote)
+
+    run(['git', 'clone', '--quiet', remote, work], cwd=root)
+    for key, value in (('user.name', 'Bench Mark'),
+                       ('user.email', 'bench@example.com'),
+                       ('git-change.gerrit-ssh-host', 'gerrit.example.com'),
+                       ('git-change.include-owners', 'true'),
+                       # The remote runs a stock receive-pack, which
+                       # does not take Gerrit's --reviewer arguments.
+                       ('git-change.push-options', 'true'),
+                       ('notes.rewriteRef', NOTES_REF)):
+        run(['git', 'config', key, value], cwd=work)
+
+    base = run(['git', 'rev-parse', 'HEAD'], cwd=work).strip()
+    stream, chain = _build_change_stream(base, paths, branches, chain_length, rng)
+    run(['git', 'fast-import', '--quiet'], cwd=work, stdin_data=stream)
+    change_ids = run(['git', 'for-each-ref', '--format=%(refname:short)', 'refs/heads/change-*'],
+                     cwd=work).split()
+    return {
+        'remote': remote,
+        'work': work,
+        'paths': paths,
+        'chain': chain,
+        'change_ids': [branch[len('change-'):] for branch in change_ids],
+        }
+
+
+def main(argv):
+    if len(argv) != 2:
+        sys.stderr.write('Usage: %s [flags] <directory>\n' % argv[0])
+        sys.exit(1)
+    root = os.path.abspath(argv[1])
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    setup = generate(root, FLAGS.files, FLAGS.depth, FLAGS['owners-density'].value,
+                     FLAGS.branches, FLAGS['chain-length'].value, FLAGS.seed)
+    print 'Generated %s and %s.' % (setup['remote'], setup['work'])
+
+
+if __name__ == '__main__':
+    main(FLAGS(sys.argv))
@@ -0,0 +1,127 @@
+# Copyright 2014 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generation of Gerrit Change-Id headers.
+
+This is a Python port of the Change-Id logic of the commit-msg hook
+that ships with Gerrit (see etc/githooks/commit-msg). Change IDs are
+computed with the same SHA1 commit-object algorithm as the hook's
+_gen_ChangeId, and the Change-Id header is placed according to the
+same footer rules (see the trailers module), so git-change does not
+depend on the hook being installed and does not pay for the
+processes it starts.
+"""
+
+import hashlib
+
+import trailers
+
+# Footer keys that, like in the commit-msg hook, are placed above the
+# Change-Id header.
+CHANGE_ID_AFTER = ('Bug', 'Issue')
+
+
+def get_change_id(message):
+    """Returns the change ID in the footer of a commit message.
+
+    Only the footer counts, as it does for Gerrit; a Change-Id line
+    elsewhere in the message (e.g. quoted in the body) is ignored, and
+    a message with only such lines needs a Change-Id header added.
+
+    Args:
+        message: A string representing a commit message.
+
+    Returns:
+        A string representing the value of the last Change-Id header in
+        the footer, or None if there is none.
+    """
+    change_ids = [v for k, v in trailers.parse_trailers(message) if k.lower() == 'change-id']
+    if change_ids:
+        return change_ids[-1]
+    return None
+
+
+def clean_message(message):
+    """Cleans a commit message the way the commit-msg hook does.
+
+    Drops everything from a 'diff --git' line on, Signed-off-by lines
+    and comment lines, then applies the rules of 'git stripspace':
+    trailing whitespace is removed, runs of blank lines are collapsed
+    and leading and trailing blank lines are removed.
+
+    Args:
+        message: A string representing a commit message.
+
+    Returns:
+        The cleaned message, without a trailing newline. Empty if the
+        message has no content.
+    """
+    lines = []
+    for line in message.split('\n'):
+        if line.startswith('diff --git a/'):
+            break
+        if line.startswith('Signed-off-by:') or line.startswith('#'):
+            continue
+        line = line.rstrip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return '\n'.join(lines)
+
+
+def generate_change_id(tree, parent, author, committer, message):
+    """Computes a change ID like the commit-msg hook's _gen_ChangeId.
+
+    Args:
+        tree: A string representing the SHA1 hash of the commit's tree.
+        parent: A string representing the SHA1 hash of the commit's
+            parent, or None for a root commit.
+        author: A string representing the author identity, e.g.
+            'Ace Hacker <ace@example.com> 1330051281 -0800'.
+        committer: A string representing the committer identity.
+        message: A string representing the commit message.
+
+    Returns:
+        A string representing the change ID, e.g.
+        'I661e66ee89a862de1f0c03c097b8d57302cade03', or None if the
+        message has no content.
+    """
+    message = clean_message(message)
+    if not message:
+        return None
+    content = 'tree %s\n' % tree
+    if parent is not None:
+        content += 'parent %s\n' % parent
+    content += 'author %s\ncommitter %s\n\n%s' % (author, committer, message)
+    sha1 = hashlib.sha1('commit %d\0%s' % (len(content), content))
+    return 'I%s' % sha1.hexdigest()
+
+
+def add_change_id(message, change_id):
+    """Adds a Change-Id header to a commit message.
+
+    If the last paragraph of the message is a footer (e.g. made of
+    'Bug: 42' and 'Signed-off-by: ...' lines), the header is inserted
+    into it after any Bug or Issue lines. Otherwise it is appended as
+    a new paragraph. See the trailers module for the footer rules.
+
+    Args:
+        message: A string representing a commit message.
+        change_id: A string representing the change ID to add.
+
+    Returns:
+        The new commit message, ending with a newline.
+    """
+    return trailers.add_trailer(message, 'Change-Id', change_id, after=CHANGE_ID_AFTER)
@@ -16,14 +16,24 @@
 
 __author__ = 'jacob@nextdoor.com (Jacob Hesch)'
 
+import atexit
+import errno
 import os
+import pipes
 import shlex
-import simplejson
+import stat
 import subprocess
 import sys
+import tempfile
+import time
+# simplejson and threading are imported by the functions that use
+# them, so that subcommands that need neither start faster.
 
 import gflags
 
+import tracing
+import trailers
+
 gflags.DEFINE_string('remote', 'origin',
                      'Name of the remote repository to fetch from and push to. '
                      'Defaults to the `git-change.remote` git config option if '
@@ -33,6 +43,14 @@ gflags.DEFINE_string('gerrit-ssh-host', None,
                      'Defaults to the `git-change.gerrit-host` git config '
                      'option if it is set. Required unless the config '
                      'option is set.')
+gflags.DEFINE_string('ssh-control-persist', None,
+                     'How long the shared ssh connection to Gerrit stays open '
+                     'while idle, in any format accepted by the ssh_config '
+                     'ControlPersist option (e.g. "600", "10m", or "0" for no '
+                     'time limit). Set to "no" to open a new connection for '
+                     'every Gerrit command. '
+                     'Defaults to the `git-change.ssh-control-persist` git '
+                     'config option if it is set, otherwise "10m".')
 
 gflags.DEFINE_bool('dry-run', False, 'Echo commands but do not execute them.', short_name='n')
 
@@ -40,6 +58,31 @@ FLAGS = gflags.FLAGS
 
 NOTES_REF = 'refs/notes/git-change'
 
+# Format version of git-change notes, stored in each note under the
+# Note-Version key. Notes without it are in the legacy 'key: value'
+# line format.
+NOTE_VERSION = 1
+
+SSH_CONTROL_PERSIST_DEFAULT = '10m'
+
+# Maximum length of an ssh ControlPath socket path.
+SSH_CONTROL_PATH_MAX = 104
+
+# Maximum number of change IDs OR-ed together in a single Gerrit
+# query. Keeps the ssh command line short and the result count well
+# under Gerrit's default query limit.
+GERRIT_QUERY_CHUNK_SIZE = 100
+
+# Gerrit change fields that never change over the life of a change
+# and can therefore be served from the change cache regardless of its
+# age.
+IMMUTABLE_CHANGE_FIELDS = ('id', 'project', 'branch', 'number', 'url')
+
+# Number of seconds cached Gerrit change data is considered fresh,
+# unless overridden by the git-change.gerrit-cache-ttl config option.
+GERRIT_CACHE_TTL_DEFAULT = 300
+
+
 
 class Error(Exception):
     """Base exception type."""
@@ -77,7 +120,7 @@ class CalledProcessError(GitError):
 
 
 def run_command(command, env=None, trap_stdout=False,
-                trap_stderr=False, output_on_error=True):
+                trap_stderr=False, output_on_error=True, stdin_data=None):
     """Runs the given command as a subprocess.
 
     By default, the subprocess inherits the stdout and stderr file
@@ -96,6 +139,9 @@ def run_command(command, env=None, trap_stdout=False,
             calling process.
         output_on_error: A boolean to flag whether to print output if
             an error running command occurs.
+        stdin_data: An optional string to write to the command's
+            stdin. If None, command inherits the stdin file handle of
+            the calling process.
 
     Returns:
         A string or tuple of strings representing the command's output
@@ -115,6 +161,8 @@ def run_command(command, env=None, trap_stdout=False,
     """
     if FLAGS['dry-run'].value:
         print 'run_command >>> %s' % command
+        if stdin_data is not None:
+            print stdin_data
         return 'dry-run-no-output\n'
 
     new_env = os.environ.copy()
@@ -123,15 +171,22 @@ def run_command(command, env=None, trap_stdout=False,
 
     command_list = shlex.split(command)
 
-    stdout = stderr = None
+    stdin = stdout = stderr = None
+    if stdin_data is not None:
+        stdin = subprocess.PIPE
     if trap_stdout:
         stdout = subprocess.PIPE
     if trap_stderr:
         stderr = subprocess.PIPE
 
-    process = subprocess.Popen(command_list, env=new_env, stdout=stdout, stderr=stderr)
-    stdout, stderr = process.communicate()
+    start_time = time.time()
+    process = subprocess.Popen(command_list, env=new_env, stdin=stdin, stdout=stdout,
+                               stderr=stderr)
+    stdout, stderr = process.communicate(stdin_data)
     return_code = process.poll()
+    tracing.record(command_list, start_time, return_code,
+                   len(stdout) if stdout is not None else None,
+                   len(stderr) if stderr is not None else None)
     if return_code:
         if output_on_error:
             print 'Error running "%s"' % command
@@ -202,16 +257,318 @@ def run_command_shell(command, env=None):
     if env is not None:
         new_env.update(env)
 
+    start_time = time.time()
     process = subprocess.Popen(command, shell=True, env=new_env)
     process.communicate()  # wait for process to terminate
     status = process.poll()
+    if tracing.is_enabled():
+        tracing.record(shlex.split(command), start_time, status)
     if status:
         raise CalledProcessError(status, command)
 
 
+def iter_command_output(args, delimiter='\0', chunk_size=65536, input_lines=None):
+    """Runs a command and yields its output one record at a time.
+
+    Unlike run_command, the output is read incrementally from the
+    subprocess pipe, so memory use is bounded by the size of a record
+    rather than the total output, and callers can start processing
+    before the command finishes.
+
+    Args:
+        args: A sequence of strings representing the command and its
+            arguments. No shell-style splitting is done.
+        delimiter: A string separating records in the output, e.g.
+            '\\0' for commands run with -z.
+        chunk_size: An integer representing the number of bytes to
+            read from the pipe at a time.
+        input_lines: An optional iterable of strings to write to the
+            command's stdin, one per line. They are written from a
+            separate thread so that a command producing output as it
+            reads input cannot deadlock.
+
+    Yields:
+        Strings representing non-empty records, without delimiters.
+
+    Raises:
+        CalledProcessError: The command exited with a non-zero status.
+    """
+    import threading
+    command = ' '.join(args)
+    if FLAGS['dry-run'].value:
+        print 'iter_command_output >>> %s' % command
+        return
+
+    stdin = subprocess.PIPE if input_lines is not None else None
+    start_time = time.time()
+    process = subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE)
+    if input_lines is not None:
+        def write_input():
+            try:
+                for line in input_lines:
+                    process.stdin.write('%s\n' % line)
+            except IOError:
+                pass  # the command exited early; its status is checked below
+            finally:
+                process.stdin.close()
+        writer = threading.Thread(target=write_input)
+        writer.daemon = True
+        writer.start()
+    pending = ''
+    stdout_bytes = 0
+    while True:
+        chunk = process.stdout.read(chunk_size)
+        if not chunk:
+            break
+        stdout_bytes += len(chunk)
+        records = (pending + chunk).split(delimiter)
+        pending = records.pop()
+        for record in records:
+            if record:
+                yield record
+    if pending:
+        yield pending
+    return_code = process.wait()
+    tracing.record(args, start_time, return_code, stdout_bytes)
+    if return_code:
+        raise CalledProcessError(return_code, command)
+
+
+class ObjectReader(object):
+    """Reads Git objects through a long-lived 'git cat-file --batch'.
+
+    Starting a git process for every object lookup is expensive in
+    large repositories. An ObjectReader starts a single cat-file
+    process on first use and sends it one request per lookup, so each
+    read is a pipe round trip rather than a fork and exec.
+
+    Use get_object_reader() to get the reader shared by the current
+    process rather than creating instances directly.
+    """
+
+    ARGV = ['git', 'cat-file', '--batch']
+
+    def __init__(self):
+        self._process = None
+        self._caller = None
+        self._start_time = None
+        self._requests = 0
+        self._bytes_read = 0
+
+    def _start(self):
+        self._caller = tracing.get_caller() if tracing.is_enabled() else None
+        self._start_time = time.time()
+        self._requests = 0
+        self._bytes_read = 0
+        self._process = subprocess.Popen(self.ARGV, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+
+    def read_object(self, name):
+        """Reads the object identified by name.
+
+        Args:
+            name: A string representing an object name or revision
+                expression, e.g. a SHA1 hash, 'HEAD' or 'HEAD^'.
+
+        Returns:
+            A tuple (sha1, type, content) of strings, or None if name
+            does not identify an object.
+
+        Raises:
+            GitError: The cat-file process terminated unexpectedly.
+        """
+        if FLAGS['dry-run'].value:
+            print 'cat-file --batch >>> %s' % name
+            return None
+        if '\n' in name:
+            return None
+        if self._process is None or self._process.poll() is not None:
+            self._start()
+
+        self._process.stdin.write('%s\n' % name)
+        self._process.stdin.flush()
+        self._requests += 1
+        header = self._process.stdout.readline()
+        self._bytes_read += len(header)
+        if not header:
+            self.close()
+            raise GitError('git cat-file exited while reading "%s"' % name)
+        parts = header.split()
+        if len(parts) != 3:
+            # Either "<name> missing" or "<name> ambiguous".
+            return None
+        sha1, object_type, size = parts
+        content = self._process.stdout.read(int(size))
+        self._process.stdout.read(1)  # trailing newline
+        self._bytes_read += len(content) + 1
+        return sha1, object_type, content
+
+    def read_commit(self, name):
+        """Reads and parses the commit identified by name.
+
+        Args:
+            name: A string representing the commit to read.
+
+        Returns:
+            A dictionary as returned by parse_commit() with an
+            additional 'sha1' key, or None if name does not identify a
+            commit.
+        """
+        result = self.read_object(name)
+        if result is None:
+            return None
+        sha1, object_type, content = result
+        if object_type != 'commit':
+            return None
+        commit = parse_commit(content)
+        commit['sha1'] = sha1
+        return commit
+
+    def close(self):
+        """Terminates the cat-file process, if it is running."""
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+        except IOError:
+            pass
+        return_code = self._process.wait()
+        tracing.record(self.ARGV, self._start_time, return_code, self._bytes_read,
+                       caller=self._caller, requests=self._requests)
+        self._process = None
+
+
+_object_reader = None
+
+
+def get_object_reader():
+    """Returns the ObjectReader shared by the current process."""
+    global _object_reader
+    if _object_reader is None:
+        _object_reader = ObjectReader()
+        atexit.register(_object_reader.close)
+    return _object_reader
+
+
+def parse_commit(content):
+    """Parses the raw content of a commit object.
+
+    Args:
+        content: A string representing the commit object as printed by
+            'git cat-file commit'.
+
+    Returns:
+        A dictionary with the following keys:
+            tree: The SHA1 hash of the commit's tree.
+            parents: A list of the SHA1 hashes of the commit's parents.
+            author: The author line, e.g. 'Ace <ace@example.com> 1330051281 -0800'.
+            committer: The committer line.
+            message: The commit message.
+            trailers: A list of (key, value) tuples representing the
+                trailer lines (e.g. Change-Id) in the footer of the
+                message, as returned by trailers.parse_trailers().
+    """
+    header, _, message = content.partition('\n\n')
+    commit = {
+        'tree': None,
+        'parents': [],
+        'author': None,
+        'committer': None,
+        'message': message,
+        'trailers': trailers.parse_trailers(message),
+        }
+    for line in header.split('\n'):
+        if line.startswith(' '):
+            continue  # continuation of a multi-line header like gpgsig
+        key, _, value = line.partition(' ')
+        if key == 'parent':
+            commit['parents'].append(value)
+        elif key in ('tree', 'author', 'committer'):
+            commit[key] = value
+    return commit
+
+
+def read_commit(commit):
+    """Reads and parses a commit with the shared ObjectReader.
+
+    Args:
+        commit: A string representing the commit to read.
+
+    Returns:
+        A dictionary as returned by ObjectReader.read_commit(), or
+        None if the commit could not be read.
+    """
+    return get_object_reader().read_commit(commit)
+
+
+_config_snapshot = None
+
+
+def _normalize_config_key(name):
+    """Normalizes a config key the way git-config does.
+
+    Section and variable names are case-insensitive while subsection
+    names are not, e.g. 'Branch.Foo.Remote' becomes 'branch.Foo.remote'.
+    """
+    section, dot, rest = name.partition('.')
+    subsection, dot2, variable = rest.rpartition('.')
+    if dot2:
+        return '%s.%s.%s' % (section.lower(), subsection, variable.lower())
+    return '%s%s%s' % (section.lower(), dot, rest.lower())
+
+
+def parse_config_list(output):
+    """Parses the output of 'git config --list -z'.
+
+    Args:
+        output: A string representing the NUL-delimited output of
+            'git config --list -z'.
+
+    Returns:
+        A dictionary mapping normalized config keys to lists of string
+        values in the order git-config reported them. Keys given
+        without a value (e.g. a bare "[core] bare") map to 'true'.
+    """
+    config = {}
+    for entry in output.split('\0'):
+        if not entry:
+            continue
+        key, newline, value = entry.partition('\n')
+        if not newline:
+            value = 'true'
+        config.setdefault(_normalize_config_key(key), []).append(value)
+    return config
+
+
+def get_config_snapshot():
+    """Returns a snapshot of all config options visible to git-config.
+
+    The snapshot is read with a single 'git config --list -z' on first
+    use and kept for the remainder of the process. Reading config has
+    no side effects, so this is done even with --dry-run.
+
+    Returns:
+        A dictionary as returned by parse_config_list().
+    """
+    global _config_snapshot
+    if _config_snapshot is None:
+        argv = ['git', 'config', '--list', '-z']
+        start_time = time.time()
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        tracing.record(argv, start_time, process.returncode, len(output), len(errors))
+        if process.returncode:
+            output = ''  # e.g. not in a repository and no global config
+        _config_snapshot = parse_config_list(output)
+    return _config_snapshot
+
+
 def get_config_option(name):
     """Returns the config option value identified by name.
 
+    Like 'git config --get', returns the last value if the option has
+    multiple values.
+
     Args:
         name: A string representing the desired config option.
 
@@ -219,16 +576,47 @@ def get_config_option(name):
         A string representing the value of the desired config option
         or None if the option was not found.
     """
-    try:
-        return run_command('git config --get %s' % name,
-                           trap_stdout=True, output_on_error=False).strip()
-    except CalledProcessError:
+    values = get_config_snapshot().get(_normalize_config_key(name))
+    if not values:
         return None
+    return values[-1].strip()
+
+
+def get_config_bool(name, default=None):
+    """Returns the boolean config option identified by name.
+
+    Values are interpreted like 'git config --type=bool' does: 'true',
+    'yes', 'on' and non-zero integers are True; 'false', 'no', 'off',
+    '0' and the empty string are False, all case-insensitively. An
+    option given without a value (a bare "[section] name") is True.
+
+    Args:
+        name: A string representing the desired config option.
+        default: The value to return if the option is not set or is
+            not a valid boolean.
+
+    Returns:
+        True or False, or default.
+    """
+    value = get_config_option(name)
+    if value is None:
+        return default
+    value = value.lower()
+    if value in ('true', 'yes', 'on'):
+        return True
+    if value in ('false', 'no', 'off', ''):
+        return False
+    try:
+        return int(value) != 0
+    except ValueError:
+        return default
 
 
 def set_config_option(name, value):
     """Sets the config option identified by name to value.
 
+    The config snapshot is updated to reflect the new value.
+
     Args:
         name: A string representing the desired config option.
         value: A string representing the desired config value.
@@ -237,8 +625,11 @@ def set_config_option(name, value):
         CalledProcessError: The git-config command returned a non-zero
             exit status.
     """
-    return run_command('git config %s %s' % (name, value),
-                       trap_stdout=True, output_on_error=False).strip()
+    output = run_command('git config %s %s' % (name, value),
+                         trap_stdout=True, output_on_error=False).strip()
+    if _config_snapshot is not None:
+        _config_snapshot[_normalize_config_key(name)] = [value]
+    return output
 
 
 def get_current_branch():
@@ -260,6 +651,219 @@ def get_current_branch():
         raise GitError('Could not get a branch name from "%s"' % output)
 
 
+_state_dir = None
+
+
+def get_state_dir():
+    """Returns the directory where git-change keeps local state.
+
+    The directory is 'git-change' inside the repository's common git
+    directory (shared by all worktrees) and is created if necessary.
+
+    Returns:
+        A string representing the absolute path to the directory, or
+        None with --dry-run, in which case no state should be written.
+    """
+    global _state_dir
+    if FLAGS['dry-run'].value:
+        return None
+    if _state_dir is None:
+        git_dir = run_command('git rev-parse --git-common-dir', trap_stdout=True).strip()
+        _state_dir = os.path.join(os.path.abspath(git_dir), 'git-change')
+        if not os.path.isdir(_state_dir):
+            os.makedirs(_state_dir)
+    return _state_dir
+
+
+def read_state_file(name, default=None):
+    """Reads a JSON file from the git-change state directory.
+
+    Args:
+        name: A string representing the file name.
+        default: The value to return if the file does not exist or
+            cannot be parsed.
+
+    Returns:
+        The decoded JSON data, or default.
+    """
+    import simplejson
+    state_dir = get_state_dir()
+    if state_dir is None:
+        return default
+    try:
+        with open(os.path.join(state_dir, name)) as f:
+            return simplejson.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def write_state_file(name, data):
+    """Atomically writes data as JSON to the git-change state directory.
+
+    Does nothing with --dry-run.
+
+    Args:
+        name: A string representing the file name.
+        data: A JSON-serializable object.
+    """
+    import simplejson
+    state_dir = get_state_dir()
+    if state_dir is None:
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=state_dir, prefix='.%s.' % name)
+    with os.fdopen(fd, 'w') as f:
+        simplejson.dump(data, f)
+    os.rename(tmp_path, os.path.join(state_dir, name))
+
+
+def delete_refs(refs):
+    """Deletes refs in a single transaction.
+
+    Each ref is deleted only if it still points to the expected
+    object; if any ref has moved, no ref is deleted. Any config
+    section of a deleted branch (e.g. its upstream) is removed too,
+    as with 'git branch -d'.
+
+    Args:
+        refs: A sequence of (ref, sha1) tuples, where ref is a full
+            ref name (e.g. 'refs/heads/change-I661e6') and sha1 is the
+            object it is expected to point to.
+
+    Raises:
+        CalledProcessError: The refs could not be deleted.
+    """
+    if not refs:
+        return
+    run_command('git update-ref --stdin',
+                stdin_data=''.join('delete %s %s\n' % (ref, sha1) for ref, sha1 in refs),
+                trap_stdout=True, trap_stderr=True, output_on_error=False)
+    config = get_config_snapshot()
+    for ref, _ in refs:
+        if not ref.startswith('refs/heads/'):
+            continue
+        section = 'branch.%s.' % ref[len('refs/heads/'):]
+        if any(key.startswith(section) for key in config):
+            run_command('git config --remove-section %s' % section[:-1],
+                        trap_stdout=True, output_on_error=False)
+            for key in [key for key in config if key.startswith(section)]:
+                del config[key]
+
+
+def get_worktree_branches():
+    """Returns the branches checked out in the repository's worktrees.
+
+    Returns:
+        A set of strings representing full ref names, e.g.
+        'refs/heads/master'.
+    """
+    output = run_command('git worktree list --porcelain', trap_stdout=True)
+    return set(line[len('branch '):] for line in output.split('\n')
+               if line.startswith('branch '))
+
+
+# Memoized result of _get_ssh_control_dir(); False until first use.
+_ssh_control_dir = False
+
+
+def get_ssh_command():
+    """Returns the ssh command line used to talk to Gerrit.
+
+    Unless connection sharing is disabled with --ssh-control-persist=no,
+    the command makes ssh start a ControlMaster process on first use
+    and route later sessions to the same host through it, so that
+    only the first Gerrit command (or push) pays for the ssh
+    handshake. The master exits after being idle for the
+    --ssh-control-persist period.
+
+    Returns:
+        A string representing the ssh command and its options, suitable
+        for run_command and for the GIT_SSH_COMMAND environment
+        variable.
+    """
+    persist = FLAGS['ssh-control-persist'].value or SSH_CONTROL_PERSIST_DEFAULT
+    if persist.lower() in ('no', 'false'):
+        return 'ssh'
+
+    global _ssh_control_dir
+    if _ssh_control_dir is False:
+        _ssh_control_dir = _get_ssh_control_dir()
+    control_dir = _ssh_control_dir
+    if control_dir is None:
+        return 'ssh'
+    control_path = os.path.join(control_dir, '%C')
+    return 'ssh -o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%s' % (
+        pipes.quote(control_path), pipes.quote(persist))
+
+
+def _get_ssh_control_dir():
+    """Returns the directory for the shared ssh connection's socket.
+
+    Anyone who can connect to the socket can use the connection, so
+    the directory lives in a user-private location ($XDG_RUNTIME_DIR
+    or ~/.ssh) and must be a real directory owned by the current user
+    and accessible only to them.
+
+    Returns:
+        A string representing the directory, created if necessary, or
+        None if no suitable directory is available, in which case the
+        connection should not be shared.
+    """
+    parent = os.environ.get('XDG_RUNTIME_DIR')
+    if not parent or not os.path.isabs(parent):
+        parent = os.path.expanduser(os.path.join('~', '.ssh'))
+    control_dir = os.path.join(parent, 'git-change')
+    # Unix socket paths are limited to about 100 characters; %C
+    # expands to 40.
+    if len(control_dir) + 41 > SSH_CONTROL_PATH_MAX:
+        return None
+    if FLAGS['dry-run'].value:
+        return control_dir
+
+    try:
+        if not os.path.isdir(parent):
+            os.mkdir(parent, 0700)
+        os.mkdir(control_dir, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            sys.stderr.write('Not sharing the ssh connection: %s\n' % e)
+            return None
+    st = os.lstat(control_dir)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+        stat.S_IMODE(st.st_mode) & 0077):
+        sys.stderr.write('Not sharing the ssh connection: %s must be a directory owned by '
+                         'you with mode 0700\n' % control_dir)
+        return None
+    return control_dir
+
+
+def get_gerrit_command(args):
+    """Returns a command that runs a Gerrit ssh command.
+
+    Args:
+        args: A string representing the Gerrit command and its
+            arguments, e.g. 'query --format=JSON change:I661e6'.
+
+    Returns:
+        A string representing the full ssh command line.
+    """
+    return '%s %s gerrit %s' % (get_ssh_command(), FLAGS['gerrit-ssh-host'].value, args)
+
+
+def get_push_env():
+    """Returns environment for git commands that talk to the remote.
+
+    Makes git use the same shared ssh connection as Gerrit commands,
+    unless the user configured their own ssh command.
+
+    Returns:
+        A dictionary to pass as the env argument of run_command.
+    """
+    if ('GIT_SSH_COMMAND' in os.environ or 'GIT_SSH' in os.environ or
+        get_config_option('core.sshCommand') is not None):
+        return {}
+    return {'GIT_SSH_COMMAND': get_ssh_command()}
+
+
 def search_gerrit(query):
     """Searches Gerrit with the given query.
 
@@ -295,12 +899,9 @@ def search_gerrit(query):
     """
     results = []
     stats = None
-    response = run_command('ssh %s gerrit query --format=JSON %s' %
-                           (FLAGS['gerrit-ssh-host'].value, query), trap_stdout=True)
-    for line in response.split('\n'):
-        if not line:
-            continue
-        result = simplejson.loads(line)
+    response = run_command(get_gerrit_command('query --format=JSON %s' % query),
+                           trap_stdout=True)
+    for result in _parse_gerrit_response(response):
         if 'type' in result and result['type'] == 'stats':
             stats = result
         else:
@@ -308,25 +909,466 @@ def search_gerrit(query):
     return results, stats
 
 
+def _parse_gerrit_response(response):
+    """Yields the JSON objects of a Gerrit query response one by one."""
+    import simplejson
+    for line in response.split('\n'):
+        if line:
+            yield simplejson.loads(line)
+
+
+def get_all_changes(change_ids):
+    """Returns all Gerrit changes with the given change IDs.
+
+    A change ID identifies one change per project and target branch,
+    e.g. a change and its cherry-picks to other branches. The changes
+    are fetched with as few Gerrit queries as possible by OR-ing the
+    change IDs together, GERRIT_QUERY_CHUNK_SIZE at a time.
+
+    Args:
+        change_ids: A sequence of strings representing change IDs.
+
+    Returns:
+        A dictionary mapping each change ID found in Gerrit to a list
+        of its change objects as described in search_gerrit(), one per
+        project and branch. Change IDs not found in Gerrit are absent
+        from the dictionary.
+    """
+    change_ids = sorted(set(change_id for change_id in change_ids if change_id))
+    changes = {}
+    for i in xrange(0, len(change_ids), GERRIT_QUERY_CHUNK_SIZE):
+        chunk = change_ids[i:i + GERRIT_QUERY_CHUNK_SIZE]
+        query = ' OR '.join('change:%s' % change_id for change_id in chunk)
+        response = run_command(get_gerrit_command('query --format=JSON %s' % query),
+                               trap_stdout=True)
+        for result in _parse_gerrit_response(response):
+            if result.get('type') == 'stats' or 'id' not in result:
+                continue
+            changes.setdefault(result['id'], []).append(result)
+    return changes
+
+
+def get_changes(change_ids):
+    """Returns the Gerrit change objects for the given change IDs.
+
+    The changes are fetched as by get_all_changes().
+
+    Args:
+        change_ids: A sequence of strings representing change IDs.
+
+    Returns:
+        A dictionary mapping each change ID found in Gerrit to its
+        change object as described in search_gerrit(). Change IDs not
+        found in Gerrit are absent from the dictionary. If a change ID
+        matches changes on several branches, the most recently updated
+        one is returned.
+    """
+    changes = dict((change_id, max(results, key=lambda change: change.get('lastUpdated', 0)))
+                   for change_id, results in get_all_changes(change_ids).iteritems())
+    cache_changes(changes.values())
+    return changes
+
+
+CHANGE_CACHE_FILE = 'changes.json'
+
+
+def _get_gerrit_cache_ttl():
+    """Returns the number of seconds cached change data stays fresh."""
+    ttl = get_config_option('git-change.gerrit-cache-ttl')
+    try:
+        return int(ttl) if ttl is not None else GERRIT_CACHE_TTL_DEFAULT
+    except ValueError:
+        return GERRIT_CACHE_TTL_DEFAULT
+
+
+def get_cached_change(change_id, fields=None):
+    """Returns Gerrit change data for change_id from the local cache.
+
+    The cache lives in the git-change state directory and maps change
+    IDs to the change objects last returned by Gerrit, along with the
+    time they were fetched (cachedOn). Entries are fresh for
+    git-change.gerrit-cache-ttl seconds. If all of the requested
+    fields are in IMMUTABLE_CHANGE_FIELDS, a stale entry is good
+    enough and only those fields are returned from it.
+
+    Args:
+        change_id: A string representing the ID of the desired change.
+        fields: An optional sequence of strings naming the change
+            fields the caller needs. If None, all fields are needed.
+
+    Returns:
+        A change object as described in search_gerrit(), or None on a
+        cache miss.
+    """
+    entry = read_state_file(CHANGE_CACHE_FILE, {}).get(change_id)
+    if entry is None:
+        return None
+    change = entry['change']
+    if time.time() - entry['cachedOn'] < _get_gerrit_cache_ttl() and 'open' in change:
+        return change
+    if fields is not None and all(f in IMMUTABLE_CHANGE_FIELDS and f in change for f in fields):
+        return dict((k, v) for k, v in change.iteritems() if k in IMMUTABLE_CHANGE_FIELDS)
+    return None
+
+
+def cache_changes(changes):
+    """Stores Gerrit change objects in the local cache.
+
+    Args:
+        changes: A sequence of change objects as described in
+            search_gerrit().
+    """
+    if not changes:
+        return
+    cache = read_state_file(CHANGE_CACHE_FILE, {})
+    now = time.time()
+    for change in changes:
+        cache[change['id']] = {'cachedOn': now, 'change': change}
+    write_state_file(CHANGE_CACHE_FILE, cache)
+
+
+def invalidate_cached_change(change_id):
+    """Discards the mutable cached data of the given change.
+
+    Call after modifying a change in Gerrit, e.g. by pushing a new
+    patch set or submitting it. The immutable fields are kept.
+
+    Args:
+        change_id: A string representing the ID of the modified change.
+    """
+    invalidate_cached_changes([change_id])
+
+
+def invalidate_cached_changes(change_ids):
+    """Discards the mutable cached data of the given changes.
+
+    Like invalidate_cached_change(), but the cache file is rewritten
+    only once.
+
+    Args:
+        change_ids: A sequence of strings representing the IDs of the
+            modified changes.
+    """
+    cache = read_state_file(CHANGE_CACHE_FILE, {})
+    modified = False
+    for change_id in change_ids:
+        entry = cache.get(change_id)
+        if entry is None:
+            continue
+        entry['change'] = dict((k, v) for k, v in entry['change'].iteritems()
+                               if k in IMMUTABLE_CHANGE_FIELDS)
+        modified = True
+    if modified:
+        write_state_file(CHANGE_CACHE_FILE, cache)
+
+
+def write_object(object_type, content):
+    """Writes an object to the object database.
+
+    Args:
+        object_type: A string representing the object type, e.g. 'commit'.
+        content: A string representing the raw object content.
+
+    Returns:
+        A string representing the SHA1 hash of the new object.
+
+    Raises:
+        CalledProcessError: The git-hash-object command returned a
+            non-zero exit status.
+    """
+    return run_command('git hash-object -t %s -w --stdin' % object_type,
+                       stdin_data=content, trap_stdout=True).strip()
+
+
+def write_tree():
+    """Writes the index as a tree object.
+
+    Returns:
+        A string representing the SHA1 hash of the tree.
+
+    Raises:
+        CalledProcessError: The git-write-tree command returned a
+            non-zero exit status, e.g. because of unmerged entries.
+    """
+    return run_command('git write-tree', trap_stdout=True).strip()
+
+
+def commit_tree(tree, parents, message):
+    """Creates a commit object without touching any ref or the index.
+
+    The author and committer identities are determined the same way
+    as for 'git commit', and the commit is signed if commit.gpgSign
+    is set.
+
+    Args:
+        tree: A string representing the SHA1 hash of the commit's tree.
+        parents: A sequence of strings representing the parent commits.
+        message: A string representing the commit message.
+
+    Returns:
+        A string representing the SHA1 hash of the new commit.
+
+    Raises:
+        CalledProcessError: The git-commit-tree command returned a
+            non-zero exit status.
+    """
+    command = 'git commit-tree %s' % tree
+    for parent in parents:
+        command = '%s -p %s' % (command, parent)
+    return run_command(command, stdin_data=message, trap_stdout=True).strip()
+
+
+def run_hook(name, args=(), env=None):
+    """Runs a Git hook if it is installed.
+
+    Args:
+        name: A string representing the hook name, e.g. 'pre-commit'.
+        args: A sequence of strings representing the hook arguments.
+        env: A dictionary of environment variables for the hook.
+
+    Raises:
+        CalledProcessError: The hook exited with a non-zero status.
+    """
+    command = 'git hook run --ignore-missing %s' % name
+    if args:
+        command = '%s -- %s' % (command, ' '.join(pipes.quote(arg) for arg in args))
+    run_command_shell(command, env=env)
+
+
+def update_ref(ref, new_sha1, old_sha1, message):
+    """Points ref at new_sha1 if it currently points at old_sha1.
+
+    Args:
+        ref: A string representing the ref to update, e.g. 'HEAD'.
+        new_sha1: A string representing the new object.
+        old_sha1: A string representing the expected current object.
+        message: A string representing the reflog message.
+
+    Raises:
+        CalledProcessError: The git-update-ref command returned a
+            non-zero exit status, e.g. because ref moved.
+    """
+    run_command('git update-ref -m "%s" %s %s %s' % (message, ref, new_sha1, old_sha1))
+
+
+def rewrite_head_message(update, reflog_message):
+    """Rewrites the message of the HEAD commit without git-commit.
+
+    The new commit object is written with 'git hash-object' and HEAD
+    moved to it with 'git update-ref', so no hooks or editor are run.
+    Notes are carried over to the new commit as with 'git commit
+    --amend' (see the notes.rewriteRef config option). A signature
+    header is dropped since it would no longer match.
+
+    Args:
+        update: A function taking the current commit message and
+            returning the new one.
+        reflog_message: A string representing the reflog message for
+            the update of HEAD.
+
+    Returns:
+        A string representing the SHA1 hash of the new HEAD commit, or
+        None if HEAD could not be read or the message did not change.
+    """
+    result = get_object_reader().read_object('HEAD')
+    if result is None:
+        return None
+    sha1, _, content = result
+    header, _, message = content.partition('\n\n')
+    new_message = update(message)
+    if new_message == message:
+        return None
+
+    header_lines = []
+    in_signature = False
+    for line in header.split('\n'):
+        if line.startswith(' ') and in_signature:
+            continue
+        in_signature = line.startswith('gpgsig')
+        if not in_signature:
+            header_lines.append(line)
+    new_sha1 = write_object('commit', '%s\n\n%s' % ('\n'.join(header_lines), new_message))
+    update_ref('HEAD', new_sha1, sha1, reflog_message)
+    run_command('git notes copy --for-rewrite=amend', stdin_data='%s %s\n' % (sha1, new_sha1),
+                trap_stdout=True, trap_stderr=True, output_on_error=False)
+    invalidate_notes_index()
+    return new_sha1
+
+
+_notes_index = None
+
+
+def _get_notes_index():
+    """Returns a dictionary mapping annotated commits to note blobs.
+
+    The mapping is read with a single 'git notes list' on first use
+    and discarded whenever git-change modifies notes.
+    """
+    global _notes_index
+    if _notes_index is None:
+        _notes_index = {}
+        try:
+            output = run_command('git notes --ref=%s list' % NOTES_REF,
+                                 trap_stdout=True, trap_stderr=True, output_on_error=False)[0]
+        except CalledProcessError:
+            output = ''  # no notes yet
+        for line in output.split('\n'):
+            parts = line.split()
+            if len(parts) == 2:
+                blob, commit = parts
+                _notes_index[commit] = blob
+    return _notes_index
+
+
+def invalidate_notes_index():
+    """Discards the notes index read by _get_notes_index().
+
+    Must be called after running a Git command that may add or copy
+    git-change notes, e.g. 'git commit --amend' with notes.rewriteRef
+    set.
+    """
+    global _notes_index
+    _notes_index = None
+
+
+def _resolve_commit(commit):
+    """Returns the SHA1 hash of commit, or None if it cannot be read."""
+    parsed_commit = read_commit(commit)
+    if parsed_commit is None:
+        return None
+    return parsed_commit['sha1']
+
+
+def _format_note(data):
+    """Formats change meta-data as the content of a git-change note.
+
+    The note is a single line holding a JSON object, so values may
+    contain any characters and new keys can be added freely.
+    """
+    import simplejson
+    record = dict((k, v) for k, v in data.iteritems() if v is not None)
+    record['Note-Version'] = NOTE_VERSION
+    return '%s\n' % simplejson.dumps(record, sort_keys=True, separators=(',', ':'))
+
+
+def _parse_note(content):
+    """Parses the content of a git-change note into a dictionary.
+
+    Both the JSON format written by _format_note() and the legacy
+    'key: value' line format are understood.
+
+    Raises:
+        ValueError: The content is not a git-change note.
+    """
+    import simplejson
+    if content.startswith('{'):
+        data = simplejson.loads(content)
+        if not isinstance(data, dict):
+            raise ValueError('Not a git-change note')
+        data.pop('Note-Version', None)
+        return data
+    data = {}
+    for line in content.split('\n'):
+        if line:
+            k, v = line.split(': ', 1)
+            data[k] = v
+    return data
+
+
 def write_note(data, commit='HEAD'):
     """Writes the given data to a Git note.
 
     Args:
         data: A dictionary mapping change meta-data keys to
-            corresponding values. Each key-value pair will be stored
-            in a Git note line. Change meta-data can be retrieved via
-            read_note().
+            corresponding values, which must be JSON-serializable.
+            Keys with a value of None are omitted. Change meta-data
+            can be retrieved via read_note(). Keys in use:
+                Change-Id: The change ID.
+                Target-Branch: The branch the change is destined for.
+                Parent-Branch: The branch the change branch was created
+                    from; a change branch if the change is chained.
+                Project: The Gerrit project of the change.
+                Change-Number: The Gerrit change number.
+                Pushed-Commit: The SHA1 hash of the commit last pushed
+                    to Gerrit as a patch set of the change.
         commit: A string representing the commit to which to attach
             the note.
 
+    Raises:
+        CalledProcessError: The git-fast-import command returned a
+            non-zero exit status.
+    """
+    write_notes({commit: data})
+
+
+def update_note(data, commit='HEAD'):
+    """Merges the given data into the Git note of a commit.
+
+    Args:
+        data: A dictionary of change meta-data as accepted by
+            write_note(). A value of None removes the key.
+        commit: A string representing the commit whose note to update.
+
+    Raises:
+        CalledProcessError: The git-fast-import command returned a
+            non-zero exit status.
+    """
+    note = read_note(commit)
+    note.update(data)
+    write_note(note, commit)
+
+
+def write_notes(notes):
+    """Writes many Git notes in a single commit to the notes ref.
+
+    The notes are written with one 'git fast-import' process rather
+    than one 'git notes add' per commit. Existing notes of the given
+    commits are replaced.
+
+    Args:
+        notes: A dictionary mapping strings representing commits to
+            dictionaries of change meta-data as accepted by write_note().
+
+    Raises:
+        CalledProcessError: The git-fast-import command returned a
+            non-zero exit status.
+    """
+    if not notes:
+        return
+    committer = run_command('git var GIT_COMMITTER_IDENT', trap_stdout=True).strip()
+    message = 'Notes added by git-change\n'
+    stream = ['commit %s\n' % NOTES_REF,
+              'committer %s\n' % committer,
+              'data %d\n%s\n' % (len(message), message)]
+    parent = _resolve_commit(NOTES_REF)
+    if parent is not None:
+        stream.append('from %s\n' % parent)
+    for commit, data in notes.iteritems():
+        content = _format_note(data)
+        stream.append('N inline %s\ndata %d\n%s\n' % (
+            _resolve_commit(commit) or commit, len(content), content))
+    run_command('git fast-import --quiet', stdin_data=''.join(stream))
+    invalidate_notes_index()
+
+
+def remove_notes(commits):
+    """Removes the git-change notes attached to the given commits.
+
+    Commits without a note are ignored.
+
+    Args:
+        commits: A sequence of strings representing commits.
+
     Raises:
         CalledProcessError: The git-notes command returned a non-zero
             exit status.
     """
-    command = 'git notes --ref=%s add ' % NOTES_REF
-    for k, v in data.iteritems():
-        command = '%s -m "%s: %s"' % (command, k, v)
-    run_command(command)
+    if not commits:
+        return
+    run_command('git notes --ref=%s remove --ignore-missing --stdin' % NOTES_REF,
+                stdin_data=''.join('%s\n' % commit for commit in commits),
+                trap_stdout=True, trap_stderr=True, output_on_error=False)
+    invalidate_notes_index()
 
 
 def read_note(commit='HEAD'):
@@ -341,16 +1383,35 @@ def read_note(commit='HEAD'):
         values. Returns an empty dictionary if there was an error
         reading the note.
     """
-    try:
-        output, _ = run_command('git notes --ref=%s show' % NOTES_REF,
-                                trap_stdout=True, trap_stderr=True,
-                                output_on_error=False)
-    except CalledProcessError:
-        return {}
+    return read_notes([commit]).get(commit, {})
 
-    data = {}
-    for line in output.split('\n'):
-        if line:
-            k, v = line.split(': ', 1)
-            data[k] = v
-    return data
+
+def read_notes(commits):
+    """Reads and returns data from the Git notes of many commits.
+
+    The notes ref is listed once, and note contents are read through
+    the shared ObjectReader, so no process is started per commit.
+
+    Args:
+        commits: A sequence of strings representing commits.
+
+    Returns:
+        A dictionary mapping each of the given commits that has a
+        readable note to a dictionary of change meta-data as returned
+        by read_note().
+    """
+    index = _get_notes_index()
+    reader = get_object_reader()
+    notes = {}
+    for commit in commits:
+        blob = index.get(_resolve_commit(commit))
+        if blob is None:
+            continue
+        result = reader.read_object(blob)
+        if result is None:
+            continue
+        try:
+            notes[commit] = _parse_note(result[2])
+        except ValueError:
+            pass  # not a git-change note
+    return notes
@@ -25,13 +25,20 @@ See git-change(1) for full documentation.
 
 __author__ = 'jacob@nextdoor.com (Jacob Hesch)'
 
+import os
+import pipes
 import sys
+import tempfile
 import time
 
 import gflags
 
+import changeid
 import git
-import git_owners
+import tracing
+import trailers
+# git_owners is imported by get_reviewers_for_change() only when OWNERS
+# files are in use.
 
 # Used mainly to provide a usage summary with -h, consistent with
 # other git commands.
@@ -50,6 +57,10 @@ gflags.DEFINE_string('skip', None, 'Comma-separated list of pre-commit checks to
 gflags.DEFINE_bool('fetch', False,
                    'Run git-fetch so that remote branch is in sync with the central repository.')
 gflags.DEFINE_bool('switch', False, 'Switch to the temporary change branch after creating it.')
+gflags.DEFINE_bool('in-place', False,
+                   'Create the change without checking out any branch. The change commit '
+                   'is built from the index and the change branch created with Git plumbing '
+                   'commands. Requires --message.')
 gflags.DEFINE_bool('chain', False,
                    'Chain with the previous Gerrit change. Use when this change depends on '
                    'the previous one. Current branch must be a temporary change branch. '
@@ -62,19 +73,29 @@ gflags.DEFINE_bool('merge-commit', False,
                    'This flag assumes the current branch is a tracking branch and '
                    'that the HEAD commit is an unreviewed merge commit for which a '
                    'review is being created. A change branch will be created and '
-                   'git-commit --amend invoked in order to have the commit-msg hook '
-                   'add a change ID header. The usual check for unmerged commits is '
+                   'a change ID header added to the merge commit if it lacks one. '
+                   'The usual check for unmerged commits is '
                    'skipped, so be sure all of the commits being merged have change '
                    'ID headers to avoid having Gerrit create a review for each one. '
                    'Finally, note that the HEAD (merge) commit in the original '
                    'tracking branch is removed after the change branch is created.')
+gflags.DEFINE_bool('gerrit', False,
+                   'With gc, also remove change branches whose Gerrit change is merged '
+                   'or abandoned, e.g. because Gerrit rebased or cherry-picked it on submit.')
+gflags.DEFINE_bool('stack', False,
+                   'With rebase, rebase the whole stack of chained change branches the '
+                   'current branch belongs to. Requires Git 2.38 or later.')
+gflags.DEFINE_bool('push-options', False,
+                   'Pass reviewers, CCs and the topic to Gerrit as git push options '
+                   'rather than as receive-pack arguments, and negotiate the objects '
+                   'to send over protocol version 2. Requires Gerrit 2.14 or later. '
+                   'Defaults to the `git-change.push-options` git config option if '
+                   'it is set.')
 gflags.DEFINE_bool('fake-push', False,
                    'Do everything except for actually pushing the change to Gerrit.')
 
 FLAGS = gflags.FLAGS
 
-BRANCH_SHORT_LENGTH = 7
-
 BASH_COLORS = {
     'YELLOW': '\033[93m',
     'GRAY': '\033[30m',
@@ -94,18 +115,20 @@ def usage(include_flags=True):
     """
     message = ('Usage: git change [create] [<create-options>]\n'
                '   or: git change update [<update-options>]\n'
-               '   or: git change rebase\n'
+               '   or: git change push-stack [-r|--reviewers=] [--cc=] [--topic=]\n'
+               '   or: git change rebase [--stack]\n'
                '   or: git change list\n'
                '   or: git change submit\n'
-               '   or: git change gc\n'
+               '   or: git change gc [--gerrit]\n'
                '   or: git change clean\n'
                '\n'
                '<create-options>: [-r|--reviewers=] [--ignore-owners=] [--cc=] [-b|--bug=] '
                '[-m|--message=] [--topic=] [--fetch] [--switch] [--chain] '
-               '[--use-head-commit] [--merge-commit] [--skip=]\n'
+               '[--use-head-commit] [--merge-commit] [--skip=] [--push-options] '
+               '[--in-place]\n'
                '\n'
                '<update-options>[-r|--reviewers=] [--ignore-owners=] [--cc=] '
-               ' [-b|--bug=] [--skip=]\n'
+               ' [-b|--bug=] [--skip=] [--push-options]\n'
                '\n'
                'See git-change(1) for full documentation.')
     print message
@@ -160,12 +183,12 @@ def get_change_id_from_commit(commit):
         A string representing the given commit's change ID if it is
         available, or None if not.
     """
-    output = git.run_command('git cat-file -p %s' % commit, trap_stdout=True)
-    lines = output.split('\n')
-    for line in lines:
-        if line.startswith('Change-Id:'):
-            _, change_id = line.split(':')
-            return change_id.strip()
+    parsed_commit = git.read_commit(commit)
+    if parsed_commit is None:
+        return None
+    change_ids = [v for k, v in parsed_commit['trailers'] if k.lower() == 'change-id']
+    if change_ids:
+        return change_ids[-1]
     return None
 
 
@@ -179,7 +202,36 @@ def get_change_id_from_head():
     return get_change_id_from_commit('HEAD')
 
 
-def get_reviewers_for_change():
+def add_change_id_to_head():
+    """Adds a Change-Id header to the HEAD commit message if it lacks one.
+
+    The change ID is computed in-process with the algorithm of the
+    Gerrit commit-msg hook (see the changeid module), and HEAD is
+    rewritten with plumbing commands rather than 'git commit --amend',
+    so neither the hook nor an editor is needed.
+
+    Returns:
+        A string representing the HEAD commit's change ID, or None if
+        the HEAD commit could not be read or has an empty message.
+    """
+    commit = git.read_commit('HEAD')
+    if commit is None:
+        return None
+    change_id = changeid.get_change_id(commit['message'])
+    if change_id is not None:
+        return change_id
+
+    parent = commit['parents'][0] if commit['parents'] else None
+    change_id = changeid.generate_change_id(commit['tree'], parent, commit['author'],
+                                            commit['committer'], commit['message'])
+    if change_id is None:
+        return None
+    git.rewrite_head_message(lambda message: changeid.add_change_id(message, change_id),
+                             'git-change: add Change-Id')
+    return change_id
+
+
+def get_reviewers_for_change(target_branch, commit='HEAD'):
     """Gets the reviewers for this change from command flag and OWNERS files.
 
     Combines two sets of Gerrit reviewer usernames to create one set of
@@ -190,6 +242,15 @@ def get_reviewers_for_change():
             flag 'ignore-owners=True'. See the git_owners module for more
             information about OWNERS files.
 
+    OWNERS files are consulted for every commit that pushing commit
+    to target_branch would send for review, so chained changes and
+    merge commits get the owners of everything they touch.
+
+    Args:
+        target_branch: A string representing the branch to which the
+            change is to be pushed.
+        commit: A string representing the commit to be pushed.
+
     Returns:
         A list of strings representing Gerrit Code Review usernames.
     """
@@ -199,37 +260,61 @@ def get_reviewers_for_change():
     repo_configured_for_owners = git.get_config_option('git-change.include-owners') == 'true'
     ignore_owners_flag = FLAGS['ignore-owners'].value
     if repo_configured_for_owners and not ignore_owners_flag:
-        reviewers.update(git_owners.get_change_owners())
+        import git_owners
+        try:
+            git.run_command('git rev-parse --verify --quiet %s/%s' % (FLAGS.remote, target_branch),
+                            trap_stdout=True, output_on_error=False)
+        except git.CalledProcessError:
+            commits = commit  # no remote branch to compare against
+        else:
+            commits = '%s/%s..%s' % (FLAGS.remote, target_branch, commit)
+        reviewers.update(git_owners.get_change_owners(commits))
 
     return [r for r in reviewers if r]
 
 
-def build_push_command(branch):
+def build_push_command(branch, commit='HEAD'):
     """Builds a git push command string for pushing a Gerrit change.
 
     The command is built using the given branch and flag values to
     populate remote repository, reviewers, users to CC, etc.
 
+    With --push-options, reviewers, CCs and the topic are sent as
+    push options. Push negotiation (push.negotiate) is turned on so
+    that, before sending the pack, git negotiates common commits with
+    the remote over protocol version 2 starting from the commit being
+    pushed. Only objects Gerrit lacks are sent, even if the local
+    remote-tracking branches are stale.
+
     Args:
         branch: A string representing the branch to which to push.
+        commit: A string representing the commit to push.
 
     Returns:
         The git push command as a string.
     """
-    command = 'git push %s' % FLAGS.remote
-    receive_pack_args = []
-
-    for reviewer in get_reviewers_for_change():
-        receive_pack_args.append('--reviewer=%s' % reviewer)
-    for cc in FLAGS.cc:
-        if cc:  # trailing commas in flag value generate blank entries
-            receive_pack_args.append('--cc=%s' % cc)
-    if receive_pack_args:
-        command = '%s --receive-pack="git receive-pack %s"' % (
-            command, ' '.join(receive_pack_args))
-    command = '%s HEAD:refs/for/%s' % (command, branch)
-    if FLAGS.topic:
-        command = '%s/%s' % (command, FLAGS.topic)
+    reviewers = get_reviewers_for_change(branch, commit)
+    cc = [c for c in FLAGS.cc if c]  # trailing commas in flag value generate blank entries
+
+    if FLAGS['push-options'].value:
+        push_options = ['reviewer=%s' % r for r in reviewers]
+        push_options.extend('cc=%s' % c for c in cc)
+        if FLAGS.topic:
+            push_options.append('topic=%s' % FLAGS.topic)
+        command = 'git -c protocol.version=2 -c push.negotiate=true push'
+        for option in push_options:
+            command = '%s -o %s' % (command, option)
+        command = '%s %s %s:refs/for/%s' % (command, FLAGS.remote, commit, branch)
+    else:
+        command = 'git push %s' % FLAGS.remote
+        receive_pack_args = ['--reviewer=%s' % r for r in reviewers]
+        receive_pack_args.extend('--cc=%s' % c for c in cc)
+        if receive_pack_args:
+            command = '%s --receive-pack="git receive-pack %s"' % (
+                command, ' '.join(receive_pack_args))
+        command = '%s %s:refs/for/%s' % (command, commit, branch)
+        if FLAGS.topic:
+            command = '%s/%s' % (command, FLAGS.topic)
     if FLAGS['fake-push'].value:
         print 'Fake pushing'
         command = 'echo %s' % command
@@ -279,28 +364,37 @@ def check_unmerged_commits(branch):
     return True
 
 
-def get_change(change_id):
+def get_change(change_id, fields=None):
     """Returns the Gerrit change object for the given change ID.
 
-    Queries Gerrit for the change_id and returns a Python object
-    created from the JSON search result.
+    Serves the change from the local change cache if possible (see
+    git.get_cached_change), otherwise queries Gerrit for the change_id
+    and returns a Python object created from the JSON search result.
 
     This function exits with a non-zero status if the Gerrit search
     returns zero or multiple results for change_id.
 
     Args:
         change_id: A string representing the ID of the desired change.
+        fields: An optional sequence of strings naming the change
+            fields the caller needs. If they are all immutable (e.g.
+            'branch' or 'project'), a cached change of any age will
+            do, and the returned object may lack other fields.
 
     Returns:
         A Python object representation of the Gerrit query JSON
         response. See git.search_gerrit and http://goo.gl/VMJih for
         the JSON data format.
     """
+    change = git.get_cached_change(change_id, fields=fields)
+    if change is not None:
+        return change
     results, _ = git.search_gerrit('change:%s' % change_id)
     if len(results) < 1:
         exit_error('Unable to find Gerrit change for ID %s.' % change_id)
     elif len(results) > 1:
         exit_error('Got multiple results searching Gerrit for %s.' % change_id)
+    git.cache_changes(results)
     return results[0]
 
 
@@ -335,38 +429,102 @@ def update_change():
     Runs a git push command to update an existing change. The change
     ID is taken from the current branch, which should be a temporary
     change branch created by a previous run of git-change.
+
+    If HEAD is the commit last pushed for the change (see the
+    Pushed-Commit note key), there is no new patch set to push, so
+    reviewers and CCs passed via flags are added over Gerrit's ssh
+    interface instead and nothing is pushed.
     """
     if FLAGS.message is not None:
         exit_error('--message cannot be used with the update subcommand.')
 
     change_id = check_for_change_branch()
-    change = get_change(change_id)
-    if not change['open']:
+    # Only the target branch is needed here, which the note usually
+    # has. If the change is no longer open and that is not known from
+    # the change cache, Gerrit rejects the push below.
+    cached_change = git.get_cached_change(change_id)
+    if cached_change is not None and not cached_change['open']:
         exit_error('Change %s is no longer open.' % change_id)
+    target_branch = get_target_branch()
+    if target_branch is None:
+        exit_error('Unable to determine the target branch of change %s.' % change_id)
+
+    note = git.read_note()
+    head = git.read_commit('HEAD')
+    pushed = head is not None and note.get('Pushed-Commit') == head['sha1']
+    has_staged_changes = bool(git.run_command('git diff --cached --name-status',
+                                              trap_stdout=True))
+    reviewers = [r for r in FLAGS.reviewers + FLAGS.cc if r]
+
+    if pushed and not has_staged_changes and FLAGS.bug is None:
+        if reviewers:
+            add_reviewers([change_id], reviewers, note.get('Project'))
+        else:
+            print 'Change %s is up to date with Gerrit; nothing to push.' % change_id
+        return
 
-    # Amend the HEAD commit if there are staged changes or if at least
-    # one of the --reviewers, --cc or --bug flags was passed. Amending
-    # the HEAD commit changes its SHA1 hash, signaling to Gerrit that
-    # we have a new patch set.
-    if (FLAGS.reviewers or FLAGS.cc or FLAGS.bug is not None or
-        git.run_command('git diff --cached --name-status', trap_stdout=True)):
+    # Amend the HEAD commit if there are staged changes or if the
+    # --bug flag was passed. Amending the HEAD commit changes its SHA1
+    # hash, signaling to Gerrit that we have a new patch set. If it is
+    # not known whether HEAD was pushed already, also amend when
+    # reviewers are to be added, so the push is not rejected.
+    if (has_staged_changes or FLAGS.bug is not None or
+        (reviewers and 'Pushed-Commit' not in note)):
         commit_change(['--amend'])
 
-    command = build_push_command(change['branch'])
+    command = build_push_command(target_branch)
     try:
-        git.run_command(command)
+        git.run_command(command, env=git.get_push_env())
     except git.CalledProcessError, e:
         # Run command prints an error message prior to raising.
         sys.exit(e.returncode)
+    finally:
+        git.invalidate_cached_change(change_id)
+    record_push()
+
+
+def add_reviewers(change_ids, reviewers, project=None):
+    """Adds reviewers to changes over Gerrit's ssh interface.
+
+    Gerrit's ssh interface has no notion of CCs, so users to CC are
+    passed here as reviewers too.
+
+    Args:
+        change_ids: A list of strings representing the IDs of the
+            changes.
+        reviewers: A list of strings representing Gerrit usernames.
+        project: An optional string representing the Gerrit project of
+            the changes, needed only if a change ID is ambiguous.
+    """
+    args = ['set-reviewers']
+    if project:
+        args.extend(['--project', project])
+    for reviewer in reviewers:
+        args.extend(['--add', reviewer])
+    args.extend(change_ids)
+    try:
+        git.run_command_or_die(git.get_gerrit_command(' '.join(args)))
+    finally:
+        git.invalidate_cached_changes(change_ids)
+
+
+def record_push():
+    """Records in the HEAD commit's note that HEAD was pushed to Gerrit."""
+    if FLAGS['fake-push'].value:
+        return
+    commit = git.read_commit('HEAD')
+    if commit is not None:
+        git.update_note({'Pushed-Commit': commit['sha1']})
 
 
 def commit_change(args=None):
     """Commits the staged change.
 
     Runs 'git commit' to commit the staged change. If a bug number was
-    specified in a flag, sets the BUG_ID environment variable so
-    the prepare-commit-msg hook can inject the bug ID into the commit
-    message.
+    specified in a flag, a Bug header is added to the commit message
+    in-process. The BUG_ID environment variable is set as well so that
+    the prepare-commit-msg hook, if installed, can show the header in
+    the editor.
 
     Args:
         args: A sequence of strings containing flags to pass to
@@ -384,9 +542,26 @@ def commit_change(args=None):
     command = 'git commit'
     if args is not None:
         command = '%s %s' % (command, ' '.join(args))
+    message_file = None
     if FLAGS.message is not None:
-        command = '%s -m "%s"' % (command, FLAGS.message)
-    git.run_command_shell(command, env=env)
+        message = FLAGS.message
+        if FLAGS.bug is not None:
+            message = trailers.set_trailer(message, 'Bug', FLAGS.bug)
+        fd, message_file = tempfile.mkstemp(prefix='git-change-msg.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(message)
+        command = '%s -F %s' % (command, message_file)
+    try:
+        git.run_command_shell(command, env=env)
+    finally:
+        if message_file is not None:
+            os.unlink(message_file)
+        # An amend copies the note of the amended commit.
+        git.invalidate_notes_index()
+
+    if FLAGS.bug is not None:
+        git.rewrite_head_message(lambda message: trailers.set_trailer(message, 'Bug', FLAGS.bug),
+                                 'git-change: add Bug header')
 
 
 def check_for_pending_changes():
@@ -410,13 +585,11 @@ def sanity_check_merge_commit():
     """
     num_parents = 0
     merge_message_seen = False
-    output = git.run_command('git cat-file -p HEAD', trap_stdout=True)
-    lines = output.split('\n')
-    for line in lines:
-        if line.startswith('parent '):
-            num_parents += 1
-        elif line.startswith('Merge branch '):
-            merge_message_seen = True
+    commit = git.read_commit('HEAD')
+    if commit is not None:
+        num_parents = len(commit['parents'])
+        merge_message_seen = any(line.startswith('Merge branch ')
+                                 for line in commit['message'].split('\n'))
     if num_parents < 2 or not merge_message_seen:
         user_input = raw_input('The HEAD commit does not look like a merge. Continue? ')
         if user_input.lower().startswith('y'):
@@ -448,8 +621,16 @@ def get_target_branch(commit='HEAD'):
         change_id = get_change_id_from_commit(commit)
         if change_id is None:
             return None
-        change = get_change(change_id)
+        change = get_change(change_id, fields=('branch',))
         target_branch = change['branch']
+        # Remember what Gerrit told us so that the next lookup does
+        # not need to ask again.
+        git.update_note({
+            'Change-Id': change_id,
+            'Target-Branch': target_branch,
+            'Project': change.get('project'),
+            'Change-Number': change.get('number'),
+            }, commit)
     return target_branch
 
 
@@ -487,8 +668,8 @@ def determine_branches():
 def commit_staged_changes(original_branch, tmp_branch):
     """Commits staged changes.
 
-    A change ID will be generated by the commit-msg hook as a
-    side-effect.
+    A change ID may be generated by the commit-msg hook as a
+    side-effect. Otherwise one is added by add_change_id_to_head().
 
     If the git-commit command fails or is interrupted by the user
     (e.g., with Control-C) the original branch is restored and the
@@ -517,6 +698,12 @@ def commit_staged_changes(original_branch, tmp_branch):
 
 def create_change():
     """Creates a Gerrit code review change."""
+    if FLAGS['in-place'].value:
+        if FLAGS.message is None:
+            exit_error('--in-place requires --message.')
+        if FLAGS['use-head-commit'].value:
+            exit_error('--in-place cannot be used with --use-head-commit or --merge-commit.')
+
     if not FLAGS['use-head-commit'].value:
         if not git.run_command('git diff --cached --name-status', trap_stdout=True):
             exit_error('You have no staged changes; exiting.\n'
@@ -542,6 +729,10 @@ def create_change():
         if check_unmerged_commits(original_branch):
             sys.exit(1)
 
+    if FLAGS['in-place'].value:
+        create_change_in_place(original_branch, target_branch)
+        return
+
     # Create and switch to a temporary branch. Once we have a change
     # ID, it will be renamed to include the ID.
     tmp_branch = 'tmp-change-%s' % time.time()
@@ -552,42 +743,35 @@ def create_change():
 
     # Now rename the branch according to the change ID.
     change_id = get_change_id_from_head()
-    if FLAGS['use-head-commit'].value and change_id is None:
-        # Amend the HEAD commit in order to force running the
-        # commit-msg hook, which should insert a Change-Id header.
-        commit_change(['--amend'])
-        change_id = get_change_id_from_head()
     if change_id is None:
-        print ('\nWARNING: Reading change ID from the HEAD commit failed. (You may need to\n'
-               'install the Gerrit commit-msg hook.) Before continuing, you need to add\n'
-               'the change ID header to the HEAD commit message (git commit --amend) and\n'
-               'rename the branch %s to change-<change-ID> manually.' % tmp_branch)
+        # Neither the commit message nor a commit-msg hook provided a
+        # Change-Id header, so add one.
+        change_id = add_change_id_to_head()
+    if change_id is None:
+        print ('\nWARNING: Reading change ID from the HEAD commit failed. Before continuing,\n'
+               'you need to add the change ID header to the HEAD commit message (git commit\n'
+               '--amend) and rename the branch %s to change-<change-ID> manually.' % tmp_branch)
         new_branch = tmp_branch
     else:
         new_branch = 'change-%s' % change_id
         git.run_command('git branch -m %s %s' % (tmp_branch, new_branch))
     print '\nCreated branch: %s\n' % new_branch
 
-    # Cache change meta-data in a note. With --chain, Parent-Branch is
-    # the temporary change branch that is the base of the
-    # chain. Without --chain, Parent-Branch and Taget-Branch are the
-    # same.
-    note = {
-        'Change-Id': change_id,
-        'Target-Branch': target_branch,
-        'Parent-Branch': original_branch,
-        }
-    git.write_note(note)
-
     command = build_push_command(target_branch)
     try:
-        git.run_command(command)
+        git.run_command(command, env=git.get_push_env())
     except git.CalledProcessError, e:
         # Roll back the commit and remove the change branch.
         git.run_command('git reset --soft HEAD^')
         git.run_command('git checkout %s' % original_branch)
         git.run_command('git branch -d %s' % new_branch)
         sys.exit(e.returncode)
+    if change_id is not None:
+        git.invalidate_cached_change(change_id)
+
+    commit = git.read_commit('HEAD')
+    write_change_note(change_id, target_branch, original_branch,
+                      commit['sha1'] if commit is not None else 'HEAD')
 
     if FLAGS['merge-commit'].value:
         # Remove the merge commit from the original branch to avoid
@@ -612,6 +796,239 @@ def create_change():
         git.run_command_or_die('git checkout %s' % original_branch)
 
 
+def get_change_stack():
+    """Returns the stack of change branches ending at the current branch.
+
+    Chained change branches are found by following the Parent-Branch
+    keys of the notes of their tip commits, starting at the current
+    branch, down to the first parent that is not a change branch.
+
+    Returns:
+        A tuple (stack, base_branch). stack is a list of (branch,
+        commit) tuples of strings, each naming a change branch and the
+        SHA1 hash of its tip commit, ordered from the bottom of the
+        stack up to the current branch. base_branch is the name of the
+        branch the bottom change branch was created from, or None if
+        it is not known.
+    """
+    stack = []
+    seen = set()
+    branch = git.get_current_branch()
+    while branch is not None and branch.startswith('change-I') and branch not in seen:
+        seen.add(branch)
+        commit = git.read_commit(branch)
+        if commit is None:
+            exit_error('Unable to read change branch %s.' % branch)
+        stack.append((branch, commit['sha1']))
+        branch = git.read_note(commit['sha1']).get('Parent-Branch')
+    stack.reverse()
+    return stack, branch
+
+
+def push_stack():
+    """Pushes all changes of a stack of chained change branches to Gerrit.
+
+    The current branch must be the top change branch of the stack.
+    All of its commits not yet in the remote target branch are pushed
+    with a single git push, which creates or updates one change per
+    commit, and the notes of all change branches are updated in a
+    single batch. Nothing is pushed if every change branch in the
+    stack is already up to date with Gerrit.
+    """
+    if FLAGS.message is not None or FLAGS.bug is not None:
+        exit_error('--message and --bug cannot be used with the push-stack subcommand.')
+
+    check_for_change_branch()
+    stack, _ = get_change_stack()
+    target_branch = get_target_branch()
+    if target_branch is None:
+        exit_error('Unable to determine the target branch of the current change branch.')
+
+    if FLAGS.fetch:
+        git.run_command('git fetch %s' % FLAGS.remote)
+
+    head = stack[-1][1]
+    upstream = '%s/%s' % (FLAGS.remote, target_branch)
+    try:
+        output = git.run_command('git rev-list %s ^%s --' % (head, upstream),
+                                 trap_stdout=True, trap_stderr=True, output_on_error=False)[0]
+    except git.CalledProcessError:
+        exit_error('Unable to read remote branch %s; try passing --fetch.' % upstream)
+    commits = output.split()
+    commit_set = set(commits)
+
+    stack = [(branch, commit) for branch, commit in stack if commit in commit_set or
+             not is_ancestor(commit, upstream)]
+    for branch, commit in stack:
+        if commit not in commit_set:
+            exit_error('Change branch %s is not part of the current branch. '
+                       'Rebase the stack and try again.' % branch)
+
+    change_ids = []
+    for commit in reversed(commits):
+        change_id = get_change_id_from_commit(commit)
+        if change_id is None:
+            exit_error('Commit %s has no Change-Id header.' % commit[:7])
+        change_ids.append(change_id)
+
+    notes = git.read_notes([commit for _, commit in stack])
+    if all(notes.get(commit, {}).get('Pushed-Commit') == commit for _, commit in stack):
+        reviewers = [r for r in FLAGS.reviewers + FLAGS.cc if r]
+        if reviewers:
+            add_reviewers(change_ids, reviewers, notes[head].get('Project'))
+        else:
+            print 'All %d changes are up to date with Gerrit; nothing to push.' % len(change_ids)
+        return
+
+    command = build_push_command(target_branch)
+    try:
+        git.run_command(command, env=git.get_push_env())
+    except git.CalledProcessError, e:
+        # Run command prints an error message prior to raising.
+        sys.exit(e.returncode)
+    finally:
+        git.invalidate_cached_changes(change_ids)
+
+    if not FLAGS['fake-push'].value:
+        updated_notes = {}
+        for _, commit in stack:
+            note = notes.get(commit, {})
+            note['Pushed-Commit'] = commit
+            updated_notes[commit] = note
+        git.write_notes(updated_notes)
+    print 'Pushed %d changes to %s.' % (len(change_ids), target_branch)
+
+
+def is_ancestor(commit, other):
+    """Returns whether commit is an ancestor of (or equal to) other."""
+    try:
+        git.run_command('git merge-base --is-ancestor %s %s' % (commit, other),
+                        output_on_error=False)
+    except git.CalledProcessError:
+        return False
+    return True
+
+
+def write_change_note(change_id, target_branch, parent_branch, commit):
+    """Caches the meta-data of a newly pushed change in a note.
+
+    With --chain, Parent-Branch is the temporary change branch that is
+    the base of the chain. Without --chain, Parent-Branch and
+    Target-Branch are the same.
+
+    Args:
+        change_id: A string representing the change ID.
+        target_branch: A string representing the target branch.
+        parent_branch: A string representing the branch the change
+            branch was created from.
+        commit: A string representing the SHA1 hash of the pushed
+            commit.
+    """
+    note = {
+        'Change-Id': change_id,
+        'Target-Branch': target_branch,
+        'Parent-Branch': parent_branch,
+        }
+    if not FLAGS['fake-push'].value:
+        note['Pushed-Commit'] = commit
+    git.write_note(note, commit)
+
+
+def create_change_in_place(original_branch, target_branch):
+    """Creates a change without checking out any branch.
+
+    The change commit is built from the index with 'git write-tree'
+    and 'git commit-tree' on top of the current branch, the change
+    branch is created with 'git update-ref', and the commit is
+    pushed. The pre-commit and commit-msg hooks are run, if
+    installed, as 'git commit' would.
+
+    With --switch or --chain, HEAD is then pointed at the change
+    branch, which needs neither the index nor the working tree to
+    change since the change commit was built from them. Otherwise
+    only the paths the change touches are restored to their state in
+    the current branch, rather than checking out whole branches.
+
+    If the push fails, the change branch is deleted, leaving the index
+    and working tree as they were.
+
+    Args:
+        original_branch: A string representing the name of the current
+            branch.
+        target_branch: A string representing the name of the branch
+            the change is destined for.
+    """
+    env = {}
+    if FLAGS.skip is not None:
+        env['SKIP'] = FLAGS.skip
+    message = FLAGS.message
+    if FLAGS.bug is not None:
+        message = trailers.set_trailer(message, 'Bug', FLAGS.bug)
+    if not message.endswith('\n'):
+        message += '\n'  # as 'git commit' passes it to the commit-msg hook
+    fd, message_file = tempfile.mkstemp(prefix='git-change-msg.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(message)
+        git.run_hook('pre-commit', env=env)
+        git.run_hook('commit-msg', [message_file], env=env)
+        with open(message_file) as f:
+            message = f.read()
+    except git.CalledProcessError, e:
+        sys.exit(e.returncode)
+    finally:
+        os.unlink(message_file)
+    message = git.run_command('git stripspace', stdin_data=message, trap_stdout=True)
+    if not message.strip():
+        exit_error('Aborting commit due to empty commit message.')
+
+    parent = git.read_commit('HEAD')['sha1']
+    tree = git.write_tree()
+    change_id = changeid.get_change_id(message)
+    if change_id is None:
+        author = git.run_command('git var GIT_AUTHOR_IDENT', trap_stdout=True).strip()
+        committer = git.run_command('git var GIT_COMMITTER_IDENT', trap_stdout=True).strip()
+        change_id = changeid.generate_change_id(tree, parent, author, committer, message)
+        message = changeid.add_change_id(message, change_id)
+    commit = git.commit_tree(tree, [parent], message)
+
+    new_branch = 'change-%s' % change_id
+    ref = 'refs/heads/%s' % new_branch
+    git.update_ref(ref, commit, '0' * 40, 'git-change: create change')
+    print '\nCreated branch: %s\n' % new_branch
+
+    command = build_push_command(target_branch, commit)
+    try:
+        git.run_command(command, env=git.get_push_env())
+    except git.CalledProcessError, e:
+        git.delete_refs([(ref, commit)])
+        sys.exit(e.returncode)
+    git.invalidate_cached_change(change_id)
+    write_change_note(change_id, target_branch, original_branch, commit)
+
+    switch = FLAGS.switch or FLAGS.chain
+    paths = git.run_command('git diff-tree -r -z --name-only --no-commit-id %s %s' %
+                            (parent, commit), trap_stdout=True).split('\0')
+    paths = [path for path in paths if path]
+    literal_env = {'GIT_LITERAL_PATHSPECS': '1'}
+    if not switch and paths:
+        try:
+            git.run_command('git diff-files --quiet -- %s' %
+                            ' '.join(pipes.quote(path) for path in paths),
+                            env=literal_env, output_on_error=False)
+        except git.CalledProcessError:
+            print ('Files of the change have unstaged modifications; '
+                   'switching to branch %s.' % new_branch)
+            switch = True
+    if switch:
+        git.run_command('git symbolic-ref -m "git-change: switch to %s" HEAD %s' %
+                        (new_branch, ref))
+    elif paths:
+        git.run_command('git restore --source=HEAD --staged --worktree '
+                        '--pathspec-from-file=- --pathspec-file-nul',
+                        env=literal_env, stdin_data='\0'.join(paths))
+
+
 def rebase():
     """Rebases the target and temporary change branches.
 
@@ -623,7 +1040,14 @@ def rebase():
 
     If there are conflicts with either rebase operation, the process
     terminates and it is up to the user to resolve the conflicts.
+
+    With --stack, all chained change branches are rebased at once; see
+    rebase_stack().
     """
+    if FLAGS.stack:
+        rebase_stack()
+        return
+
     check_for_change_branch()
     target_branch = get_target_branch()
     change_branch = git.get_current_branch()
@@ -648,23 +1072,128 @@ def rebase():
         sys.exit(e.returncode)
 
 
-def get_change_branches():
-    """Returns temporary change branches.
+def rebase_stack():
+    """Rebases a whole stack of chained change branches.
+
+    The stack is found by following Parent-Branch notes down from the
+    current branch and up to the single chain of change branches
+    created on top of it. The target branch is fast-forwarded with a
+    single fetch, then the top branch of the stack is rebased onto it
+    with 'git rebase --update-refs', which moves every change branch
+    further down the stack along with it. Notes follow the rewritten
+    commits through the notes.rewriteRef config option.
+
+    If there are conflicts, the process terminates and it is up to the
+    user to resolve them and run 'git rebase --continue', which
+    finishes updating the change branches.
+    """
+    check_for_change_branch()
+    target_branch = get_target_branch()
+    if target_branch is None:
+        exit_error('Unable to determine the target branch of the current change branch.')
+    current_branch = git.get_current_branch()
+    top_branch = get_stack_top(current_branch)
+
+    # Fetching into the local target branch fast-forwards it and, via
+    # the remote's fetch refspec, its remote-tracking branch.
+    try:
+        git.run_command('git fetch %s %s:%s' % (FLAGS.remote, target_branch, target_branch))
+    except git.CalledProcessError, e:
+        print ('Updating branch %s failed. If it has commits not yet in %s/%s, rebase it\n'
+               'with "git pull --rebase" first, then run "git change rebase --stack" again.' %
+               (target_branch, FLAGS.remote, target_branch))
+        sys.exit(e.returncode)
+
+    if top_branch != current_branch:
+        git.run_command_or_die('git checkout %s' % top_branch)
+    try:
+        git.run_command('git rebase --update-refs %s' % target_branch)
+    except git.CalledProcessError, e:
+        print ('Rebase of the change stack failed. After resolving merge failure(s),\n'
+               'run "git rebase --continue" to finish rebasing and updating the change\n'
+               'branches. See "git help rebase" for help on resolving merge conflicts.')
+        sys.exit(e.returncode)
+    if top_branch != current_branch:
+        git.run_command_or_die('git checkout %s' % current_branch)
+
 
-    Temporary change branch names match the pattern 'change-*'.
+def get_stack_top(branch):
+    """Returns the top change branch of the stack the given branch is in.
+
+    Change branches chained on top of branch are found through the
+    Parent-Branch keys of the notes of all change branches, which are
+    read in a single batch.
+
+    Args:
+        branch: A string representing the name of a change branch.
 
     Returns:
-        A sequence of strings each representing a branch names, sorted
-        in chronological order based on the author date of each
-        branch's HEAD commit.
+        A string representing the name of the change branch at the
+        top of the stack, which is branch itself if no change branch
+        was chained on it.
     """
     output = git.run_command(
-        'git for-each-ref --format="%(refname:short)" --sort=authordate refs/heads/change-*',
+        'git for-each-ref --format="%(refname:short) %(objectname)" refs/heads/change-*',
         trap_stdout=True)
-    if output:
-        return output.strip().split('\n')
-    else:
-        return []
+    tips = dict(line.split() for line in output.split('\n') if line)
+    notes = git.read_notes(tips.values())
+    children = {}
+    for child, commit in tips.iteritems():
+        parent = notes.get(commit, {}).get('Parent-Branch')
+        if parent is not None:
+            children.setdefault(parent, []).append(child)
+
+    seen = set([branch])
+    while branch in children:
+        if len(children[branch]) > 1:
+            exit_error('Branches %s are all chained on %s; check out the top of the stack '
+                       'to rebase and try again.' % (', '.join(sorted(children[branch])), branch))
+        branch = children[branch][0]
+        if branch in seen:
+            break
+        seen.add(branch)
+    return branch
+
+
+def get_change_branch_details():
+    """Returns details about all temporary change branches.
+
+    All details are read with a single 'git for-each-ref' call, plus
+    one more to determine which branches are merged into HEAD.
+
+    Returns:
+        A sequence of dictionaries sorted in chronological order based
+        on the author date of each branch's HEAD commit, each with the
+        following keys:
+            branch: The branch name.
+            commit: The abbreviated SHA1 hash of the branch's HEAD commit.
+            subject: The subject line of that commit.
+            current: True if the branch is checked out.
+            merged: True if the branch is merged into HEAD.
+    """
+    output = git.run_command(
+        'git for-each-ref --sort=authordate '
+        '--format="%(refname:short)%00%(objectname:short)%00%(HEAD)%00%(subject)" '
+        'refs/heads/change-*', trap_stdout=True)
+    not_merged = git.run_command(
+        'git for-each-ref --no-merged=HEAD --format="%(refname:short)" refs/heads/change-*',
+        trap_stdout=True).split('\n')
+    not_merged = set(branch for branch in not_merged if branch)
+
+    details = []
+    for line in output.split('\n'):
+        fields = line.split('\0')
+        if len(fields) != 4:
+            continue
+        branch, commit, head, subject = fields
+        details.append({
+            'branch': branch,
+            'commit': commit,
+            'subject': subject,
+            'current': head == '*',
+            'merged': branch not in not_merged,
+            })
+    return details
 
 
 def list_change_branches():
@@ -673,39 +1202,31 @@ def list_change_branches():
     Lists the branches and prompts user with a menu to check one of
     them out.
     """
-    branches = get_change_branches()
+    branches = get_change_branch_details()
     if not branches:
         print 'You have no change branches to list'
         return
 
-    not_merged_branches = git.run_command('git branch --no-merged',
-                                          trap_stdout=True).strip().split('\n')
-    not_merged_branches = [line.strip()[BRANCH_SHORT_LENGTH:] for line in not_merged_branches]
+    # handle colors here
+    use_color = git.get_config_option('git-change.color')
+    use_color = (use_color != 'false')  # auto or yes or anything else count as True
+
+    cid_url = git.get_config_option('git-change.cid-url') or ''
 
     print 'Change branches:\n'
     i = 0
-    for branch in branches:
+    for details in branches:
         i += 1
+        short_branch = details['branch'][0:16]
 
-        output = git.run_command('git log --oneline -1 %s --' % branch, trap_stdout=True)
-        change_id = output.split(' ')[0]
-        description = ' '.join(output.split(' ')[1:])
-        short_branch = branch[0:16]
-        change_branch = branch.split('-')[1]
-
-        # handle colors here
-        use_color = git.get_config_option('git-change.color')
-        use_color = (use_color != 'false')  # auto or yes or anything else count as True
-
-        cid_url = git.get_config_option('git-change.cid-url') or ''
-
-        if use_color and change_branch not in not_merged_branches:  # not not == is merged
+        if use_color and details['merged']:
             sys.stdout.write(COLOR_OBSOLETE)
 
-        if use_color and change_branch == get_change_id_from_branch():
+        if use_color and details['current']:
             sys.stdout.write(COLOR_CURRENT)
-        sys.stdout.write('{i:>2}: {branch_id} {href}{cid} {name}'.format(
-            i=i, branch_id=short_branch, href=cid_url, cid=change_id, name=description))
+        sys.stdout.write('{i:>2}: {branch_id} {href}{cid} {name}\n'.format(
+            i=i, branch_id=short_branch, href=cid_url, cid=details['commit'],
+            name=details['subject']))
         if use_color:
             sys.stdout.write(COLOR_CLEAR)
     try:
@@ -715,7 +1236,7 @@ def list_change_branches():
         # User pressed or Ctrl-D or Ctrl-C.
         return
     if selection.isdigit() and int(selection) <= len(branches):
-        git.run_command_or_die('git checkout %s' % branches[int(selection) - 1])
+        git.run_command_or_die('git checkout %s' % branches[int(selection) - 1]['branch'])
     elif selection:
         print 'Not a valid selection'
     else:
@@ -731,32 +1252,101 @@ def submit_change():
 
     commit = git.run_command('git rev-parse --verify HEAD', trap_stdout=True)
     project = change['project']
-    git.run_command_or_die('ssh %s gerrit review --project %s --submit %s' %
-                           (FLAGS['gerrit-ssh-host'].value, project, commit))
+    try:
+        git.run_command_or_die(git.get_gerrit_command('review --project %s --submit %s' %
+                                                      (project, commit)))
+    finally:
+        git.invalidate_cached_change(change_id)
+
+
+def get_closed_change_branches(branches):
+    """Returns the change branches whose Gerrit change is closed.
+
+    A change ID may match several Gerrit changes, e.g. when a change
+    was cherry-picked to another branch, so each branch is matched to
+    the change on the target branch recorded in its git-change note.
+    If the note does not say, the branch is only considered closed if
+    all changes with its change ID are.
+
+    Args:
+        branches: A sequence of (ref, sha1) tuples, where ref is the full
+            ref name of a change branch and sha1 its HEAD commit.
+
+    Returns:
+        A set of strings representing the refs of branches whose change
+        is merged or abandoned.
+    """
+    notes = git.read_notes([sha1 for _, sha1 in branches])
+    changes = git.get_all_changes(ref[len('refs/heads/change-'):] for ref, _ in branches)
+    closed = set()
+    for ref, sha1 in branches:
+        candidates = changes.get(ref[len('refs/heads/change-'):], [])
+        target_branch = notes.get(sha1, {}).get('Target-Branch')
+        if target_branch is not None:
+            candidates = [change for change in candidates if change.get('branch') == target_branch]
+        if candidates and all(change.get('status') in ('MERGED', 'ABANDONED')
+                              for change in candidates):
+            closed.add(ref)
+    return closed
 
 
 def garbage_collect(force=False):
-    """Removes temporary change branches which are fully merged."""
+    """Removes temporary change branches which are fully merged.
+
+    Merged status of all change branches is determined with one
+    'git for-each-ref' call, and the branches are deleted, along with
+    the git-change notes of their HEAD commits, in one transaction.
+
+    With --gerrit, branches whose Gerrit change is merged or abandoned
+    are removed too, even if they are not merged locally. The status
+    of all changes is fetched with as few Gerrit queries as possible
+    (see git.get_all_changes).
+
+    Branches checked out in any worktree are never removed.
+
+    Args:
+        force: If True, remove all change branches whether they are
+            merged or not.
+    """
     current_branch = git.get_current_branch()
     if current_branch.startswith('change-I'):
         exit_error('`git-change gc` cannot be run from a change branch.')
 
-    unmerged_branches = []
-    deleted = False
-    for branch in get_change_branches():
-        try:
-            if force:
-                git.run_command('git branch -D %s' % branch, trap_stderr=True, output_on_error=False)
-            else:
-                # Note: git branch -d prints 'Deleted branch ...' to stdout.
-                git.run_command('git branch -d %s' % branch, trap_stderr=True, output_on_error=False)
-        except git.CalledProcessError:
-            unmerged_branches.append(branch)
-        else:
-            deleted = True
+    format_arg = '--format="%(refname) %(objectname)"'
+    output = git.run_command('git for-each-ref %s refs/heads/change-*' % format_arg,
+                             trap_stdout=True)
+    branches = [line.split(' ') for line in output.split('\n') if line]
+    if force:
+        deletable = set(ref for ref, _ in branches)
+    else:
+        output = git.run_command('git for-each-ref --merged=HEAD %s refs/heads/change-*' %
+                                 format_arg, trap_stdout=True)
+        deletable = set(line.split(' ')[0] for line in output.split('\n') if line)
+        if FLAGS.gerrit:
+            deletable.update(get_closed_change_branches(
+                [(ref, sha1) for ref, sha1 in branches if ref not in deletable]))
+
+    # Unlike 'git branch -d', update-ref does not refuse to delete a
+    # branch that is checked out in another worktree.
+    checked_out = deletable.intersection(git.get_worktree_branches())
+    deletable.difference_update(checked_out)
+
+    to_delete = [(ref, sha1) for ref, sha1 in branches if ref in deletable]
+    unmerged_branches = [ref[len('refs/heads/'):] for ref, _ in branches
+                         if ref not in deletable and ref not in checked_out]
+    try:
+        git.delete_refs(to_delete)
+    except git.CalledProcessError, e:
+        exit_error('Deleting change branches failed:\n%s' % e.stderr)
+    git.remove_notes([sha1 for _, sha1 in to_delete])
+    for ref, sha1 in to_delete:
+        print 'Deleted branch %s (was %s).' % (ref[len('refs/heads/'):], sha1[:7])
+    for ref in sorted(checked_out):
+        print 'Skipped branch %s, which is checked out in another worktree.' % (
+            ref[len('refs/heads/'):])
 
     if unmerged_branches:
-        if deleted:
+        if to_delete:
             print  # Blank line between deleted branches and the message below.
         print ('The following change branches could not be deleted, probably because they\n'
                'are not fully merged into the current branch. You might try first running\n'
@@ -769,7 +1359,7 @@ def print_push_command():
     """Prints the command to push a change to Gerrit."""
     change_id = get_change_id_from_branch()
     if change_id is not None:
-        change = get_change(change_id)
+        change = get_change(change_id, fields=('branch',))
         target_branch = change['branch']
     else:
         target_branch = git.get_current_branch()
@@ -810,6 +1400,19 @@ def configure():
         exit_error('Please define git config option "git-change.gerrit-ssh-host" '
                    'or pass --gerrit-ssh-host.')
 
+    # Get the idle lifetime of the shared ssh connection from
+    # command-line flag or config option, otherwise fall back to the
+    # default.
+    ssh_control_persist = FLAGS['ssh-control-persist']
+    if not ssh_control_persist.present:
+        ssh_control_persist.value = git.get_config_option('git-change.ssh-control-persist')
+
+    # Get the push mode from command-line flag or config option,
+    # otherwise fall back to flag default.
+    if not FLAGS['push-options'].present:
+        FLAGS['push-options'].value = git.get_config_bool('git-change.push-options',
+                                                          FLAGS['push-options'].value)
+
     # --merge-commit implies --use-head-commit.
     if FLAGS['merge-commit'].value:
         FLAGS['use-head-commit'].value = True
@@ -820,11 +1423,6 @@ def main(argv):
         usage(include_flags=False)
         sys.exit()
 
-    # Fail gracefully if run outside a git repository.
-    git.run_command_or_die('git status')
-
-    configure()
-
     argc = len(argv)
     if argc > 2:
         usage(include_flags=False)
@@ -833,11 +1431,20 @@ def main(argv):
         subcommand = argv[1]
     else:
         subcommand = 'create'  # default subcommand
+    tracing.start(subcommand)
+
+    # Fail gracefully if run outside a git repository. Unlike 'git
+    # status', this does not scan the working tree.
+    git.run_command_or_die('git rev-parse --git-dir')
+
+    configure()
 
     if subcommand == 'create':
         create_change()
     elif subcommand == 'update':
         update_change()
+    elif subcommand == 'push-stack':
+        push_stack()
     elif subcommand == 'rebase':
         rebase()
     elif subcommand == 'list':
@@ -35,73 +35,323 @@ usernames in owners files, with newlines between each one.
 
 __author__ = 'mcqueen@nextdoor.com (Sean McQueen)'
 
+import itertools
 import os
 
 import git
 
 OWNERS_FILE = 'OWNERS'
 
-def get_change_owners():
+# Name and format version of the persisted OWNERS files of recently
+# used trees and their parsed contents, kept in the git-change state
+# directory, and the number of trees kept.
+OWNERS_INDEX_FILE = 'owners-index'
+OWNERS_INDEX_VERSION = 2
+OWNERS_INDEX_MAX_TREES = 8
+
+# Mode of a gitlink (submodule) entry in a tree.
+SUBMODULE_MODE = '160000'
+
+
+class OwnersIndex(object):
+    """Maps repository directories to their owners.
+
+    The index is built from the set of directories containing an
+    OWNERS file. The owners of any other directory are those of its
+    nearest ancestor with an OWNERS file, and are memoized as they are
+    resolved, so looking up the owners of N directories costs
+    O(N * depth) dictionary lookups and no file system access.
+    """
+
+    def __init__(self, owners_by_dir):
+        """Initializes the index.
+
+        Args:
+            owners_by_dir: A dictionary mapping repository-relative
+                paths of directories containing an OWNERS file ('' for
+                the repository root) to lists of owners.
+        """
+        self._owners = dict(owners_by_dir)
+
+    def get_owners(self, rel_dir):
+        """Returns the owners of a directory.
+
+        Args:
+            rel_dir: A string representing the path of a directory
+                relative to the repository root ('' for the root).
+
+        Returns:
+            A list of strings representing Gerrit usernames.
+        """
+        unresolved = []
+        path = rel_dir
+        while path not in self._owners:
+            unresolved.append(path)
+            if not path:
+                owners = []
+                break
+            path = os.path.dirname(path)
+        else:
+            owners = self._owners[path]
+        for path in unresolved:
+            self._owners[path] = owners
+        return owners
+
+
+_owners_indexes = {}
+_repo_root = None
+
+
+def get_change_owners(commits='HEAD'):
     """Gets owners of changed files from OWNERS files.
 
+    The changed files are those changed by any of the given commits,
+    relative to any of their parents, so a merge commit's owners
+    include the owners of files that differ from either side of the
+    merge. OWNERS files are read from the newest of the commits, which
+    therefore need not be checked out.
+
+    Args:
+        commits: A string representing a commit (e.g. 'HEAD') or a
+            commit range (e.g. 'origin/master..HEAD'), or a sequence of
+            strings representing commits ordered from oldest to newest.
+
     Returns:
         A list of strings representing Gerrit usernames with no duplicates.
     """
+    commits = _resolve_commits(commits)
+    if not commits:
+        return []
+    index = get_owners_index(commits[-1])
     owners = set()
-    for directory in get_directories_with_changes():
-        owners.update(get_owners_for_dir(directory))
+    for directory in _iter_relative_directories_with_changes(commits):
+        owners.update(index.get_owners(directory))
     return list(owners)
 
 
-def get_directories_with_changes():
-    """Gets the absolute paths to the parent directories of changed files.
+def get_directories_with_changes(commits='HEAD'):
+    """Generates the absolute paths to the parent directories of changed files.
 
-    Returns:
-        A list of strings representing the absolute paths to directories of
-        files changed in the last commit.
-    """
-    # Get a list of changed files in the HEAD commit.
-    changed_files = git.run_command(
-        'git diff --name-only HEAD^ HEAD', trap_stdout=True).split('\n')[:-1]
+    Args:
+        commits: A commit, commit range or sequence of commits as
+            accepted by get_change_owners().
 
-    # Return absolute paths to the parent dirs of changed files.
+    Yields:
+        Strings representing the absolute paths to directories of
+        files changed in the given commits, each directory once.
+    """
     repo_root = _get_repo_root()
-    dir_paths = [os.path.dirname(os.path.join(repo_root, path)) for path in changed_files]
-    return list(set(dir_paths))
+    for path in _iter_relative_directories_with_changes(_resolve_commits(commits)):
+        yield os.path.join(repo_root, path) if path else repo_root
+
 
+def _resolve_commits(commits):
+    """Turns a commit, commit range or sequence of commits into a list of SHA1s."""
+    if isinstance(commits, basestring):
+        if '..' in commits:
+            return list(git.iter_command_output(['git', 'rev-list', '--reverse', commits],
+                                                delimiter='\n'))
+        commits = [commits]
+    shas = []
+    for commit in commits:
+        parsed_commit = git.read_commit(commit)
+        if parsed_commit is not None:
+            shas.append(parsed_commit['sha1'])
+    return shas
 
-def get_owners_for_dir(dir_path):
-    """Gets the owners of a directory by recursively looking in OWNERS files.
+
+def _iter_relative_directories_with_changes(commits):
+    """Generates the repository-relative parent directories of changed files.
+
+    All commits are fed to a single 'git diff-tree --stdin' process,
+    and its NUL-delimited output is streamed, so directories are
+    yielded while git is still producing the diff and memory use does
+    not grow with the number of changed files.
+    """
+    seen = set()
+    for path in git.iter_command_output(
+            ['git', 'diff-tree', '--stdin', '-z', '-r', '-m', '--root',
+             '--name-only', '--no-commit-id'],
+            input_lines=commits):
+        directory = os.path.dirname(path)
+        if directory not in seen:
+            seen.add(directory)
+            yield directory
+
+
+def get_owners_for_dir(dir_path, commit='HEAD'):
+    """Gets the owners of a directory from the nearest OWNERS file.
 
     If a directory does not contain an OWNERS file, the owners of the directory
     are the owners of the directory's parent.
 
     Args:
         dir_path: A string representing the absolute path to a directory.
+        commit: A string representing the commit from which to read
+            OWNERS files.
 
     Returns:
         A list of strings representing Gerrit usernames.
     """
-    # If we have recursed past the top of the repo, there are no owners.
-    if dir_path == os.path.dirname(_get_repo_root()):
-        return []
+    rel_dir = os.path.relpath(dir_path, _get_repo_root())
+    if rel_dir == '.':
+        rel_dir = ''
+    elif rel_dir.startswith('..'):
+        return []  # outside the repository
+    return get_owners_index(commit).get_owners(rel_dir)
+
 
-    # If this directory exists, attempt to find it's explicit owners.
-    if os.path.exists(dir_path):
-        for file in os.listdir(dir_path):
-            file_path = os.path.join(dir_path, file)
-            if _is_owners_file(file_path):
-                return [line.strip() for line in open(file_path, 'r')]
+def get_owners_index(commit='HEAD'):
+    """Returns the OwnersIndex of the given commit.
 
-    # Otherwise, recurse up the tree to find the owners for this directory.
-    return get_owners_for_dir(os.path.dirname(dir_path))
+    Indexes are built on first use and shared by all commits with the
+    same tree.
+
+    Args:
+        commit: A string representing the commit from which to read
+            OWNERS files.
+
+    Returns:
+        An OwnersIndex.
+    """
+    parsed_commit = git.read_commit(commit)
+    if parsed_commit is None:
+        return OwnersIndex({})
+    tree = parsed_commit['tree']
+    if tree not in _owners_indexes:
+        _owners_indexes[tree] = build_owners_index(tree)
+    return _owners_indexes[tree]
+
+
+def build_owners_index(tree):
+    """Builds an OwnersIndex from the OWNERS files in a git tree.
+
+    The location and blob ID of every OWNERS file of the most recently
+    used trees are persisted in the git-change state directory, along
+    with the parsed contents of those blobs, so:
+
+    - For a tree seen before, no git command is run at all.
+    - Otherwise, if any tree is cached, the OWNERS files that differ
+      from the most recently used one are found with 'git diff-tree',
+      which skips unchanged subtrees, so the cost depends on the size
+      of the difference (e.g. after a rebase) rather than of the tree.
+    - Otherwise, all OWNERS files are listed with a single 'git
+      ls-tree' call.
+
+    Only blobs not in the cache are read, through the shared
+    git.ObjectReader. Neither the working tree nor the index is
+    consulted, so this works for commits that are not checked out and
+    in bare repositories.
+
+    Args:
+        tree: A string representing a tree, or a commit whose tree
+            should be used.
+
+    Returns:
+        An OwnersIndex.
+    """
+    parsed_commit = git.read_commit(tree)
+    if parsed_commit is not None:
+        tree = parsed_commit['tree']
+
+    cache = git.read_state_file(OWNERS_INDEX_FILE, {})
+    if cache.get('version') != OWNERS_INDEX_VERSION:
+        cache = {}
+    cached_owners = cache.get('blobs', {})
+    cached_trees = cache.get('trees', [])
+
+    blobs_by_dir = dict(cached_trees).get(tree)
+    if blobs_by_dir is None:
+        if cached_trees:
+            base_tree, blobs_by_dir = cached_trees[0]
+            blobs_by_dir = _patch_owners_blobs(dict(blobs_by_dir), base_tree, tree)
+        else:
+            blobs_by_dir = _list_owners_blobs(tree)
+
+    owners_by_blob = {}
+    owners_by_dir = {}
+    reader = git.get_object_reader()
+    for directory, blob in blobs_by_dir.items():
+        if blob in cached_owners:
+            owners = cached_owners[blob]
+        else:
+            result = reader.read_object(blob)
+            if result is None:
+                del blobs_by_dir[directory]
+                continue
+            owners = _parse_owners(result[2])
+        owners_by_blob[blob] = owners
+        owners_by_dir[directory] = owners
+
+    if not cached_trees or cached_trees[0][0] != tree:
+        trees = [[tree, blobs_by_dir]]
+        trees.extend(entry for entry in cached_trees if entry[0] != tree)
+        trees = trees[:OWNERS_INDEX_MAX_TREES]
+        for _, other_blobs_by_dir in trees[1:]:
+            for blob in other_blobs_by_dir.itervalues():
+                if blob not in owners_by_blob and blob in cached_owners:
+                    owners_by_blob[blob] = cached_owners[blob]
+        git.write_state_file(OWNERS_INDEX_FILE, {'version': OWNERS_INDEX_VERSION,
+                                                 'blobs': owners_by_blob,
+                                                 'trees': trees})
+    return OwnersIndex(owners_by_dir)
+
+
+def _list_owners_blobs(tree):
+    """Returns a dictionary mapping directories to OWNERS blob IDs.
+
+    Lists the whole tree with a single 'git ls-tree' call.
+    """
+    output = git.run_command('git ls-tree -r -z --full-tree %s' % tree, trap_stdout=True)
+    blobs_by_dir = {}
+    for entry in output.split('\0'):
+        # Entries look like '<mode> <type> <object>\t<path>'.
+        info, _, path = entry.partition('\t')
+        if os.path.basename(path) != OWNERS_FILE:
+            continue
+        _, object_type, blob = info.split(' ')
+        if object_type == 'blob':
+            blobs_by_dir[os.path.dirname(path)] = blob
+    return blobs_by_dir
+
+
+def _patch_owners_blobs(blobs_by_dir, base_tree, tree):
+    """Updates the OWNERS blob IDs of base_tree to those of tree.
+
+    Args:
+        blobs_by_dir: A dictionary mapping directories to the blob IDs
+            of their OWNERS files in base_tree. It is modified in place.
+        base_tree: A string representing the tree blobs_by_dir
+            describes.
+        tree: A string representing the tree to describe.
+
+    Returns:
+        blobs_by_dir.
+    """
+    records = git.iter_command_output(['git', 'diff-tree', '-r', '-z', base_tree, tree])
+    # Records alternate between ':<old mode> <new mode> <old object>
+    # <new object> <status>' and the path.
+    for info, path in itertools.izip(records, records):
+        if os.path.basename(path) != OWNERS_FILE:
+            continue
+        _, new_mode, _, blob, status = info.split(' ')
+        directory = os.path.dirname(path)
+        if status == 'D' or new_mode == SUBMODULE_MODE:
+            blobs_by_dir.pop(directory, None)
+        else:
+            blobs_by_dir[directory] = blob
+    return blobs_by_dir
 
 
-def _is_owners_file(path):
-    """Checks if the given path is a path to a OWNERS file."""
-    return os.path.isfile(path) and os.path.basename(path) == OWNERS_FILE
+def _parse_owners(content):
+    """Parses the contents of an OWNERS file into a list of usernames."""
+    return [line.strip() for line in content.split('\n') if line.strip()]
 
 
 def _get_repo_root():
     """Returns the absolute path to the root of the git repo."""
-    return git.run_command('git rev-parse --show-toplevel', trap_stdout=True).strip()
+    global _repo_root
+    if _repo_root is None:
+        _repo_root = git.run_command('git rev-parse --show-toplevel',
+                                     trap_stdout=True).strip()
+    return _repo_root
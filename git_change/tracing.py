@@ -0,0 +1,208 @@
+# Copyright 2014 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tracing of the subprocesses git-change runs.
+
+All git and ssh commands are run through the git module, which reports
+each one to record() when tracing is enabled. Tracing is enabled by
+the --trace flag, which prints a summary of where the time went when
+git-change exits, or by setting the GIT_CHANGE_TRACE environment
+variable to the name of a file, to which every subprocess is written
+as an event in the Chrome trace event format. The file can be loaded
+into chrome://tracing or https://ui.perfetto.dev, and since each event
+is on a line of its own it is easy to process with line-oriented
+tools too.
+"""
+
+import atexit
+import os
+import sys
+import time
+
+import gflags
+
+gflags.DEFINE_bool('trace', False,
+                   'Print a summary of the time spent in git and ssh subprocesses on exit. '
+                   'Set the GIT_CHANGE_TRACE environment variable to a file name to also '
+                   'write a trace of every subprocess to that file.')
+
+FLAGS = gflags.FLAGS
+
+TRACE_FILE_ENV_VAR = 'GIT_CHANGE_TRACE'
+
+# Modules whose functions are not reported as the callers of
+# subprocesses; the function that called into them is reported
+# instead.
+_INTERNAL_MODULES = ('git', 'tracing')
+
+_start_time = time.time()
+_events = []
+_subcommand = None
+_finish_registered = False
+
+
+def is_enabled():
+    """Returns True if subprocesses are to be traced."""
+    return FLAGS['trace'].value or bool(os.environ.get(TRACE_FILE_ENV_VAR))
+
+
+def start(subcommand):
+    """Starts tracing a git-change subcommand, if tracing is enabled.
+
+    The trace is written and the summary printed when the process
+    exits.
+
+    Args:
+        subcommand: A string representing the name of the subcommand
+            being run, e.g. 'create'.
+    """
+    global _subcommand, _finish_registered
+    _subcommand = subcommand
+    if is_enabled() and not _finish_registered:
+        atexit.register(finish)
+        _finish_registered = True
+
+
+def get_caller():
+    """Returns the name of the function that started a subprocess.
+
+    That is the innermost function on the stack outside of the git
+    and tracing modules, e.g. 'git_change.update_change'.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+        if module not in _INTERNAL_MODULES:
+            return '%s.%s' % (module, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def record(argv, start_time, return_code, stdout_bytes=None, stderr_bytes=None, caller=None,
+           **details):
+    """Records a finished subprocess.
+
+    Does nothing if tracing is not enabled.
+
+    Args:
+        argv: A sequence of strings representing the command line.
+        start_time: A float representing the time the subprocess was
+            started, in seconds since the epoch.
+        return_code: An integer representing the exit status, or None
+            if it is not known.
+        stdout_bytes: An integer representing the number of bytes read
+            from the subprocess's stdout, or None if it was not trapped.
+        stderr_bytes: An integer representing the number of bytes read
+            from the subprocess's stderr, or None if it was not trapped.
+        caller: A string representing the function that started the
+            subprocess. Defaults to the result of get_caller().
+        details: Additional JSON-serializable data about the subprocess.
+    """
+    if not is_enabled():
+        return
+    end_time = time.time()
+    event = {
+        'argv': list(argv),
+        'start': start_time,
+        'duration': end_time - start_time,
+        'return_code': return_code,
+        'stdout_bytes': stdout_bytes,
+        'stderr_bytes': stderr_bytes,
+        'caller': caller or get_caller(),
+        }
+    event.update(details)
+    _events.append(event)
+
+
+def get_command_name(argv):
+    """Returns a short name for a command line, used to group events.
+
+    Args:
+        argv: A sequence of strings representing the command line.
+
+    Returns:
+        A string such as 'git push' or 'ssh gerrit query'.
+    """
+    if not argv:
+        return ''
+    program = os.path.basename(argv[0])
+    args = list(argv[1:])
+    if program == 'git':
+        while len(args) > 1 and args[0] in ('-c', '-C'):
+            args = args[2:]
+        return 'git %s' % args[0] if args else program
+    if program == 'ssh' and 'gerrit' in args:
+        rest = args[args.index('gerrit') + 1:]
+        return 'ssh gerrit %s' % rest[0] if rest else 'ssh gerrit'
+    return program
+
+
+def _to_chrome_event(event):
+    """Converts an event to a Chrome trace 'complete' event."""
+    args = dict((k, v) for k, v in event.iteritems()
+                if k not in ('start', 'duration') and v is not None)
+    return {
+        'name': get_command_name(event['argv']),
+        'cat': _subcommand or 'git-change',
+        'ph': 'X',
+        'ts': int((event['start'] - _start_time) * 1e6),
+        'dur': int(event['duration'] * 1e6),
+        'pid': os.getpid(),
+        'tid': 0,
+        'args': args,
+        }
+
+
+def write_trace(path):
+    """Writes the recorded events to a file in Chrome trace format.
+
+    Args:
+        path: A string representing the name of the file to write.
+    """
+    import simplejson
+    lines = [simplejson.dumps(_to_chrome_event(event), sort_keys=True) for event in _events]
+    with open(path, 'w') as f:
+        f.write('{"traceEvents": [\n%s\n]}\n' % ',\n'.join(lines))
+
+
+def format_summary():
+    """Returns a summary of the recorded events as a string.
+
+    The time spent in subprocesses is broken down by command and by
+    the calling function. Long-lived subprocesses like 'git cat-file
+    --batch' run concurrently with others, so the times may add up to
+    more than the total.
+    """
+    lines = ['git-change %s: %d subprocesses in %.3fs' % (
+        _subcommand or '', len(_events), time.time() - _start_time)]
+    for title, key in (('command', lambda event: get_command_name(event['argv'])),
+                       ('caller', lambda event: event['caller'] or '?')):
+        groups = {}
+        for event in _events:
+            groups.setdefault(key(event), []).append(event['duration'])
+        lines.append('')
+        lines.append('%6s %9s %9s  %s' % ('count', 'total', 'max', title))
+        for name, durations in sorted(groups.iteritems(), key=lambda item: -sum(item[1])):
+            lines.append('%6d %8.3fs %8.3fs  %s' % (
+                len(durations), sum(durations), max(durations), name))
+    return '\n'.join(lines)
+
+
+def finish():
+    """Writes the trace file and prints the summary, as configured."""
+    path = os.environ.get(TRACE_FILE_ENV_VAR)
+    if path:
+        write_trace(path)
+    if FLAGS['trace'].value:
+        sys.stderr.write('%s\n' % format_summary())
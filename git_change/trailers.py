@@ -0,0 +1,215 @@
+# Copyright 2014 Nextdoor.com, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parsing and insertion of commit message trailers.
+
+Trailers (also called footers or headers) are the 'Key: value' lines
+in the last paragraph of a commit message, e.g.:
+
+    Log interesting events
+
+    Bug: 442
+    Change-Id: I661e66ee89a862de1f0c03c097b8d57302cade03
+    Signed-off-by: Ace Hacker <ace@example.com>
+
+The footer rules are those of the commit-msg hook that ships with
+Gerrit: the first paragraph (the subject) is never a footer, lines of
+the form '[name: comment]' may appear in a footer, and comment lines
+and anything from a 'diff --git' line on are ignored. A trailing
+block of comment lines, as found in the message template git passes
+to the prepare-commit-msg hook, is preserved at the end of the
+message. This module has no dependencies on the rest of git-change so
+that Git hooks can import it.
+"""
+
+import re
+
+FOOTER_PATTERN = re.compile(r'^\[?[a-zA-Z0-9-]+:')
+FOOTER_COMMENT_PATTERN = re.compile(r'^\[[a-zA-Z0-9-]+:')
+URL_PATTERN = re.compile(r'^[a-zA-Z0-9-]+://')
+TRAILER_PATTERN = re.compile(r'^([a-zA-Z0-9-]+):\s*(.*)$')
+SCISSORS_LINE = '# ------------------------ >8 ------------------------'
+
+
+def _split_message(message):
+    """Splits a message into body lines and tail lines.
+
+    The tail is the trailing block of comment lines, if any, plus
+    everything from a scissors line on. Anything from a 'diff --git'
+    line on is dropped. Comment lines within the body are dropped too.
+    """
+    lines = message.split('\n')
+    if message.endswith('\n'):
+        lines.pop()
+
+    tail = []
+    for i, line in enumerate(lines):
+        if line == SCISSORS_LINE:
+            tail = lines[i:]
+            lines = lines[:i]
+            break
+        if line.startswith('diff --git a'):
+            lines = lines[:i]
+            break
+
+    start = len(lines)
+    while start > 0 and (lines[start - 1].startswith('#') or not lines[start - 1].strip()):
+        start -= 1
+    while start < len(lines) and not lines[start].startswith('#'):
+        start += 1
+    tail = lines[start:] + tail
+    body = [line for line in lines[:start] if not line.startswith('#')]
+    return body, tail
+
+
+def _split_footer(body):
+    """Splits body lines into the lines before the footer and the footer.
+
+    This is a port of the awk program of Gerrit's commit-msg hook. The
+    body is parsed as (textLine+ blankLine*)*, and the last block of
+    text lines is the footer if all of its lines look like trailers.
+
+    Returns:
+        A tuple (head, footer) of lists of lines. If there is no
+        footer, footer is empty and head ends with a blank line, ready
+        for a new footer paragraph.
+    """
+    head = []
+    lines = []  # the current block of text lines
+    is_footer = False
+    footer_comment = 0
+    blank_lines = 0
+
+    for line in body:
+        if not line and footer_comment == 0:
+            blank_lines += 1
+            continue
+        if FOOTER_COMMENT_PATTERN.match(line) and is_footer:
+            footer_comment = 1
+        if line.endswith(']') and footer_comment == 1:
+            footer_comment = 2
+
+        if blank_lines > 0:
+            # A text line after blank lines: the previous block is
+            # not the footer.
+            head.extend(lines or [''])
+            head.extend([''] * blank_lines)
+            lines = []
+            blank_lines = 0
+            is_footer = True
+            footer_comment = 0
+
+        if footer_comment == 0 and (not FOOTER_PATTERN.match(line) or URL_PATTERN.match(line)):
+            is_footer = False
+        if footer_comment == 2:
+            footer_comment = 0
+        lines.append(line)
+
+    if not is_footer:
+        head.extend(lines or [''])
+        head.append('')
+        lines = []
+    return head, lines
+
+
+def _join(lines, tail):
+    """Joins body and tail lines into a message ending with a newline.
+
+    The tail, if any, is separated from the body by one blank line.
+    """
+    lines = list(lines)
+    while lines and not lines[-1] and tail:
+        lines.pop()
+    if tail:
+        lines.append('')
+    return '%s\n' % '\n'.join(lines + tail)
+
+
+def parse_trailers(message):
+    """Parses the trailers in the footer of a commit message.
+
+    Args:
+        message: A string representing a commit message.
+
+    Returns:
+        A list of (key, value) tuples in the order they appear. Empty
+        if the message has no footer.
+    """
+    body, _ = _split_message(message)
+    _, footer = _split_footer(body)
+    trailers = []
+    for line in footer:
+        match = TRAILER_PATTERN.match(line)
+        if match is not None:
+            trailers.append((match.group(1), match.group(2).strip()))
+    return trailers
+
+
+def add_trailer(message, key, value, after=()):
+    """Adds a trailer to a commit message.
+
+    If the message has a footer, the trailer is inserted into it,
+    after any leading trailers whose keys are in after (compared
+    case-insensitively). Otherwise the trailer is appended as a new
+    paragraph.
+
+    Args:
+        message: A string representing a commit message.
+        key: A string representing the trailer key, e.g. 'Change-Id'.
+        value: A string representing the trailer value.
+        after: A sequence of strings representing the keys of
+            trailers that should precede the new one.
+
+    Returns:
+        The new commit message, ending with a newline.
+    """
+    body, tail = _split_message(message)
+    head, footer = _split_footer(body)
+    new_line = '%s: %s' % (key, value)
+    after = set(k.lower() for k in after)
+    index = 0
+    while index < len(footer) and footer[index].split(':', 1)[0].lower() in after:
+        index += 1
+    footer.insert(index, new_line)
+    return _join(head + footer, tail)
+
+
+def set_trailer(message, key, value, after=()):
+    """Sets the value of a trailer, adding the trailer if necessary.
+
+    If the footer already has a trailer with the given key (compared
+    case-insensitively) and a single-word value, e.g. 'Bug: 442', the
+    last such trailer is replaced. Lines outside the footer, and lines
+    with longer values such as 'bug: crash on empty input', are prose
+    and never touched. Otherwise the trailer is added as with
+    add_trailer().
+
+    Args:
+        message: A string representing a commit message.
+        key: A string representing the trailer key, e.g. 'Bug'.
+        value: A string representing the trailer value.
+        after: A sequence of strings representing the keys of
+            trailers that should precede the new one.
+
+    Returns:
+        The new commit message, ending with a newline.
+    """
+    body, tail = _split_message(message)
+    head, footer = _split_footer(body)
+    pattern = re.compile(r'^%s:\s*\S*\s*$' % re.escape(key), re.IGNORECASE)
+    for index in xrange(len(footer) - 1, -1, -1):
+        if pattern.match(footer[index]):
+            footer[index] = '%s: %s' % (key, value)
+            return _join(head + footer, tail)
+    return add_trailer(message, key, value, after=after)